@@ -0,0 +1,170 @@
+"""
+Coalesced writes of the activity timestamps of the users: the last login
+of `auth_user` and the last seen time of `UserActivity`.
+
+Instead of an UPDATE per login or API call, timestamps are buffered in the
+process, keeping the latest one per user, and written with one UPDATE per
+batch (see `api.buffers`). In web processes they are written at least
+every `API_ACTIVITY_MAX_STALENESS` seconds, so that is how stale they may
+be. Timestamps never move backwards, whatever the order the processes
+write them in.
+"""
+from collections import defaultdict
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Case, DateTimeField, F, Q, Value, When
+from django.utils import timezone
+from django.utils.deprecation import MiddlewareMixin
+
+from . import sharding
+from .buffers import BufferedWriter
+from .models import UserActivity
+
+
+MAX_STALENESS = getattr(settings, 'API_ACTIVITY_MAX_STALENESS', 60)
+BATCH_SIZE = getattr(settings, 'API_ACTIVITY_BATCH_SIZE', 1000)
+MAX_BUFFER = getattr(settings, 'API_ACTIVITY_MAX_BUFFER', 100000)
+
+
+def latest(field, timestamps):
+    """
+    Returns an expression setting `field` to the timestamp of each user,
+    unless the stored one is more recent.
+    """
+    return Case(*[
+        When(Q(pk=user_id) & (Q(**{'%s__isnull' % field: True}) |
+                              Q(**{'%s__lt' % field: timestamp})),
+             then=Value(timestamp))
+        for user_id, timestamp in timestamps.items()
+    ], default=F(field), output_field=DateTimeField())
+
+
+class TimestampWriter(BufferedWriter):
+    """
+    Buffers a timestamp per user: a user is queued once, and only its
+    latest timestamp is written. Subclasses implement `update`.
+    """
+    # users per UPDATE, within the query parameter limit of SQLite as each
+    # user takes four parameters
+    update_size = 200
+
+    def __init__(self, **kwargs):
+        super(TimestampWriter, self).__init__(**kwargs)
+        self.timestamps = {}
+        self.timestamps_lock = threading.Lock()
+
+    def update(self, timestamps):
+        raise NotImplementedError('subclasses of TimestampWriter must provide an update() method')  # noqa
+
+    def add(self, item):
+        user_id, timestamp = item
+
+        with self.timestamps_lock:
+            queued = user_id in self.timestamps
+            if not queued or self.timestamps[user_id] < timestamp:
+                self.timestamps[user_id] = timestamp
+
+        if not queued and not super(TimestampWriter, self).add(user_id):
+            with self.timestamps_lock:
+                self.timestamps.pop(user_id, None)
+            return False
+
+        return True
+
+    def write(self, user_ids):
+        with self.timestamps_lock:
+            timestamps = dict((user_id, self.timestamps.pop(user_id))
+                              for user_id in user_ids
+                              if user_id in self.timestamps)
+
+        items = list(timestamps.items())
+        for start in range(0, len(items), self.update_size):
+            self.update(dict(items[start:start + self.update_size]))
+
+
+class LastLoginWriter(TimestampWriter):
+    def update(self, timestamps):
+        # the users may be on several shards
+        databases = defaultdict(dict)
+        for user_id, timestamp in timestamps.items():
+            alias = sharding.lookup_shard(user_id) \
+                if sharding.is_enabled() else None
+            databases[alias][user_id] = timestamp
+
+        for alias, batch in databases.items():
+            User.objects.using(alias).filter(pk__in=batch) \
+                        .update(last_login=latest('last_login', batch))
+
+
+class LastSeenWriter(TimestampWriter):
+    def update(self, timestamps):
+        existing = set(UserActivity.objects.filter(pk__in=timestamps)
+                                           .values_list('pk', flat=True))
+        missing = [UserActivity(user_id=user_id, last_seen=timestamp)
+                   for user_id, timestamp in timestamps.items()
+                   if user_id not in existing]
+
+        if missing:
+            try:
+                with transaction.atomic():
+                    UserActivity.objects.bulk_create(missing)
+                created = missing
+            except IntegrityError:
+                # some were created meanwhile by another process, and the
+                # whole insert was rolled back. Insert the others one by
+                # one, the ones created meanwhile are updated below.
+                created = []
+                for instance in missing:
+                    try:
+                        with transaction.atomic():
+                            instance.save(force_insert=True)
+                    except IntegrityError:
+                        continue
+                    created.append(instance)
+
+            created_ids = set(instance.user_id for instance in created)
+            timestamps = dict((user_id, timestamp)
+                              for user_id, timestamp in timestamps.items()
+                              if user_id not in created_ids)
+
+        if timestamps:
+            UserActivity.objects.filter(pk__in=timestamps) \
+                .update(last_seen=latest('last_seen', timestamps))
+
+
+last_login_writer = LastLoginWriter(batch_size=BATCH_SIZE,
+                                    interval=MAX_STALENESS,
+                                    max_size=MAX_BUFFER)
+last_seen_writer = LastSeenWriter(batch_size=BATCH_SIZE,
+                                  interval=MAX_STALENESS,
+                                  max_size=MAX_BUFFER)
+
+
+def record_login(user_id, when=None):
+    last_login_writer.add((user_id, when or timezone.now()))
+
+
+def record_seen(user_id, when=None):
+    last_seen_writer.add((user_id, when or timezone.now()))
+
+
+def flush():
+    return last_login_writer.flush() + last_seen_writer.flush()
+
+
+class ActivityMiddleware(MiddlewareMixin):
+    """
+    Records when the users making authenticated requests were last seen.
+    """
+
+    def process_response(self, request, response):
+        # set by django rest framework for token authenticated requests
+        user = getattr(request, 'user', None)
+
+        if user is not None and user.is_authenticated():
+            record_seen(user.pk)
+
+        return response
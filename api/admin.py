@@ -1,3 +1,162 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR
+from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.functional import cached_property
 
-# Register your models here.
+from oauth2_provider.models import AccessToken, RefreshToken
+
+from .cache import invalidate_tokens
+
+
+CURSOR_VAR = 'before'
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator that does not count all the rows of large tables.
+
+    Unfiltered lists on PostgreSQL use the row estimate of the planner
+    statistics. Otherwise rows are only counted up to `max_count`.
+    """
+    max_count = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class '
+                               'WHERE relname = %s',
+                               [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > self.max_count:
+                return int(row[0])
+
+        return queryset[:self.max_count].count()
+
+
+class UserChangeList(ChangeList):
+    """
+    A changelist paginated by primary key instead of by page number when
+    browsing in the default order, so deep pages cost the same as the first
+    one. Only the columns of the list are loaded.
+    """
+
+    def get_queryset(self, request):
+        queryset = super(UserChangeList, self).get_queryset(request)
+        queryset = queryset.only(*self.model_admin.list_only)
+
+        cursor = getattr(request, 'keyset_cursor', None)
+        if cursor is not None:
+            queryset = queryset.filter(pk__lt=cursor)
+
+        return queryset
+
+    def get_results(self, request):
+        super(UserChangeList, self).get_results(request)
+
+        # evaluated once here, querysets do not support negative indexing
+        self.result_list = list(self.result_list)
+        self.next_cursor_query = None
+
+        if ORDER_VAR not in self.params and \
+                len(self.result_list) == self.list_per_page:
+            self.next_cursor_query = self.get_query_string(
+                {CURSOR_VAR: self.result_list[-1].pk})
+
+
+class UserAdmin(BaseUserAdmin):
+    """
+    User admin that stays responsive on tables with millions of users.
+    """
+    change_list_template = 'admin/api/user/change_list.html'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    ordering = ('-pk', )
+    list_display = ('email', 'first_name', 'last_name', 'is_active',
+                    'is_staff', 'date_joined')
+    list_filter = ('is_active', 'is_staff', 'is_superuser')
+    list_select_related = False
+    list_only = ('pk', 'username') + list_display
+
+    # prefix search on LOWER(field), backed by the indexes created in
+    # `api/migrations/0004_user_admin_search_indexes`
+    search_fields = ('email', 'first_name', 'last_name')
+
+    actions = ['activate_users', 'deactivate_users', 'revoke_tokens']
+
+    def get_changelist(self, request, **kwargs):
+        return UserChangeList
+
+    def changelist_view(self, request, extra_context=None):
+        # the cursor is not a lookup, so it is hidden from the changelist
+        if CURSOR_VAR in request.GET:
+            request.GET = request.GET.copy()
+            try:
+                request.keyset_cursor = int(request.GET.pop(CURSOR_VAR)[0])
+            except ValueError:
+                pass
+
+        return super(UserAdmin, self).changelist_view(request, extra_context)
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip().lower()
+
+        if not search_term:
+            return queryset, False
+
+        annotations = {}
+        condition = Q()
+        for field in self.search_fields:
+            annotations['%s_lower' % field] = Lower(field)
+            condition |= Q(**{'%s_lower__startswith' % field: search_term})
+
+        return queryset.annotate(**annotations).filter(condition), False
+
+    def invalidate_tokens(self, users):
+        # the update bypasses the signals dropping the cached tokens
+        invalidate_tokens(AccessToken.objects.filter(user__in=users)
+                                             .values_list('token', flat=True))
+
+    def set_active(self, request, queryset, is_active):
+        updated = User.objects.filter(pk__in=queryset.values('pk')) \
+                              .update(is_active=is_active)
+        self.invalidate_tokens(queryset.values('pk'))
+
+        self.message_user(request, '%s user(s) %s.' % (
+            updated, 'activated' if is_active else 'deactivated'),
+            messages.SUCCESS)
+
+    def activate_users(self, request, queryset):
+        self.set_active(request, queryset, True)
+    activate_users.short_description = 'Activate selected users'
+
+    def deactivate_users(self, request, queryset):
+        self.set_active(request, queryset, False)
+    deactivate_users.short_description = 'Deactivate selected users'
+
+    def revoke_tokens(self, request, queryset):
+        users = queryset.values('pk')
+
+        RefreshToken.objects.filter(user__in=users).delete()
+        revoked = AccessToken.objects.filter(user__in=users,
+                                             expires__gt=timezone.now()) \
+                                     .update(expires=timezone.now())
+        self.invalidate_tokens(users)
+
+        self.message_user(request, '%s token(s) revoked.' % revoked,
+                          messages.SUCCESS)
+    revoke_tokens.short_description = 'Revoke access tokens of selected users'
+
+
+admin.site.unregister(User)
+admin.site.register(User, UserAdmin)
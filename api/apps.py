@@ -1,8 +1,8 @@
 from django.apps import AppConfig
 
 
-class BurjConfig(AppConfig):
-    name = 'burj'
+class ApiConfig(AppConfig):
+    name = 'api'
 
     def ready(self):
-        import burj.signals  # noqa
+        import api.signals  # noqa
@@ -0,0 +1,70 @@
+"""
+Audit trail of the account events of `api.views`.
+
+Events are not written by the request recording them: they are buffered
+in the process and written with `bulk_create` in batches of
+`API_AUDIT_BATCH_SIZE`, at least every `API_AUDIT_FLUSH_INTERVAL` seconds
+(see `api.buffers`). Events recorded while `API_AUDIT_MAX_BUFFER` events
+are waiting are dropped rather than slowing down requests, and events
+still buffered when a process is killed are lost.
+"""
+from datetime import timedelta
+import json
+
+from django.conf import settings
+from django.utils import timezone
+
+from .buffers import BufferedWriter
+from .models import AuditEvent
+
+
+BATCH_SIZE = getattr(settings, 'API_AUDIT_BATCH_SIZE', 500)
+FLUSH_INTERVAL = getattr(settings, 'API_AUDIT_FLUSH_INTERVAL', 2)
+MAX_BUFFER = getattr(settings, 'API_AUDIT_MAX_BUFFER', 10000)
+
+
+def get_retention_days():
+    return getattr(settings, 'API_AUDIT_RETENTION_DAYS', 365)
+
+
+class AuditWriter(BufferedWriter):
+    def write(self, events):
+        AuditEvent.objects.bulk_create(events)
+
+
+writer = AuditWriter(batch_size=BATCH_SIZE, interval=FLUSH_INTERVAL,
+                     max_size=MAX_BUFFER)
+
+
+def get_client_ip(request):
+    # behind a proxy, REMOTE_ADDR must be set from the forwarded headers by
+    # the proxy or the server, which alone know which ones to trust
+    return request.META.get('REMOTE_ADDR') or None
+
+
+def record(event, user_id=None, request=None, **data):
+    """
+    Buffers an event of the user, with the IP address of the request and
+    `data` as details.
+    """
+    writer.add(AuditEvent(
+        user_id=user_id,
+        event=event,
+        ip=get_client_ip(request) if request is not None else None,
+        data=json.dumps(data, sort_keys=True),
+        created=timezone.now(),
+    ))
+
+
+def flush():
+    return writer.flush()
+
+
+def purge(days=None):
+    """
+    Deletes the events older than `days`, `API_AUDIT_RETENTION_DAYS` by
+    default. Returns the number of events deleted.
+    """
+    if days is None:
+        days = get_retention_days()
+    return AuditEvent.objects.purge(timezone.now() - timedelta(days=days))
@@ -0,0 +1,151 @@
+"""
+In-process dispatch of the sub-requests of a `/api/batch/` call.
+
+Sub-requests are resolved against `api.urls` and passed straight to their
+views, skipping the middleware, with the user the batch request was
+authenticated as. Consecutive GET requests are independent reads and run
+concurrently; any other request waits for the ones before it, so writes
+are applied in order.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import json
+import logging
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connection
+from django.urls import Resolver404, resolve
+
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = '/api/'
+
+# views that cannot be batched: the batch view itself, login which needs a
+# form-encoded body, streaming responses and non-JSON responses
+EXCLUDED_VIEWS = ('api_batch', 'api_login', 'api_users_export',
+                  'api_profiling')
+
+
+def get_max_size():
+    return getattr(settings, 'API_BATCH_MAX_SIZE', 20)
+
+
+def get_max_workers():
+    return getattr(settings, 'API_BATCH_MAX_WORKERS', 4)
+
+
+def build_request(request, method, path, body):
+    """
+    Returns a Django request for the sub-request, sharing the headers and
+    the authentication of the batch request.
+    """
+    url = urlsplit(path)
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+
+    environ = dict(request._request.META)
+    environ.update({
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': url.path,
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(payload)),
+        'wsgi.input': BytesIO(payload),
+    })
+
+    sub_request = WSGIRequest(environ)
+    sub_request.user = request.user
+
+    if request.user.is_authenticated():
+        # picked up by rest_framework.request.Request instead of
+        # authenticating the sub-request again. An anonymous user would be
+        # taken as authenticated, and get 403 instead of 401.
+        sub_request._force_auth_user = request.user
+        sub_request._force_auth_token = request.auth
+
+    return sub_request
+
+
+def get_response_body(response):
+    if hasattr(response, 'data'):
+        return response.data
+
+    if response.content:
+        try:
+            return json.loads(response.content.decode('utf-8'))
+        except ValueError:
+            return response.content.decode('utf-8')
+
+    return None
+
+
+def dispatch(request, item):
+    """
+    Runs a single sub-request and returns its status and body.
+    """
+    path = urlsplit(item['path']).path
+
+    try:
+        if not path.startswith(API_PREFIX):
+            raise Resolver404()
+        match = resolve('/' + path[len(API_PREFIX):], urlconf='api.urls')
+        if match.url_name in EXCLUDED_VIEWS:
+            raise Resolver404()
+    except Resolver404:
+        return {'status': 404, 'body': {'detail': 'Not found.'}}
+
+    sub_request = build_request(request, item['method'], item['path'],
+                                item.get('body'))
+
+    try:
+        response = match.func(sub_request, *match.args, **match.kwargs)
+    except Exception:
+        logger.exception('Batch sub-request %s %s failed',
+                         item['method'], item['path'])
+        return {'status': 500, 'body': {'detail': 'Server error.'}}
+
+    return {'status': response.status_code,
+            'body': get_response_body(response)}
+
+
+def dispatch_concurrently(request, items, executor):
+    def run(item):
+        try:
+            return dispatch(request, item)
+        finally:
+            # each worker thread has its own database connection
+            connection.close()
+
+    return list(executor.map(run, items))
+
+
+def execute(request, items):
+    """
+    Runs the sub-requests and returns their results in order.
+    """
+    max_workers = get_max_workers()
+    results = []
+    reads = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def flush_reads():
+            if len(reads) > 1 and max_workers > 1:
+                results.extend(dispatch_concurrently(request, reads,
+                                                     executor))
+            else:
+                results.extend(dispatch(request, read) for read in reads)
+            del reads[:]
+
+        for item in items:
+            if item['method'] == 'GET':
+                reads.append(item)
+            else:
+                flush_reads()
+                results.append(dispatch(request, item))
+
+        flush_reads()
+
+    return results
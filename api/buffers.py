@@ -0,0 +1,132 @@
+"""
+Buffered writes for data that can be written a little late, in batches,
+instead of with a query per request.
+
+Items are collected in a bounded in-process queue. In web processes (see
+`dubai/wsgi.py`), a background thread writes them every `interval` seconds
+or as soon as `batch_size` items are waiting. Elsewhere, e.g. in
+management commands and tests, they are written by the thread adding the
+`batch_size`th item, or by calling `flush`, and whatever is left when the
+process exits is lost.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+_background = False
+
+
+def enable_background_flush():
+    """
+    Makes buffers flush from a background thread. Called once by the web
+    server entry point; the threads are started lazily in each process.
+    """
+    global _background
+    _background = True
+
+
+class BufferedWriter(object):
+    """
+    A bounded buffer written in batches by `write`, which subclasses
+    implement. Items added while the buffer is full are dropped and
+    counted in `dropped`, so that a slow database never blocks requests.
+    """
+
+    def __init__(self, batch_size=500, interval=2.0, max_size=10000):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=max_size)
+        self.dropped = 0
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def write(self, items):
+        raise NotImplementedError('subclasses of BufferedWriter must provide a write() method')  # noqa
+
+    def add(self, item):
+        """
+        Buffers the item. Returns False if it was dropped.
+        """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('%s is full, dropped %s item(s) so far',
+                           self.__class__.__name__, self.dropped)
+            return False
+
+        if _background:
+            self.ensure_thread()
+            if self.queue.qsize() >= self.batch_size:
+                self.wakeup.set()
+        elif self.queue.qsize() >= self.batch_size:
+            self.flush()
+
+        return True
+
+    def drain(self, limit):
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def flush(self):
+        """
+        Writes everything buffered so far. Returns the number of items
+        written.
+        """
+        count = 0
+
+        # a single writer at a time keeps the batches in order
+        with self.lock:
+            while True:
+                items = self.drain(self.batch_size)
+                if not items:
+                    return count
+
+                try:
+                    self.write(items)
+                except Exception:
+                    logger.exception('%s failed to write %s item(s)',
+                                     self.__class__.__name__, len(items))
+                else:
+                    count += len(items)
+
+    def ensure_thread(self):
+        # threads do not survive a fork, so check the process as well
+        if self.thread is not None and self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                if self.thread is None:
+                    # write what is left when the server stops
+                    atexit.register(self.flush)
+
+                self.pid = os.getpid()
+                self.thread = threading.Thread(
+                    target=self.run, name=self.__class__.__name__)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+            try:
+                self.flush()
+            finally:
+                connection.close()
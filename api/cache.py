@@ -0,0 +1,194 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+PROFILE_CACHE_TIMEOUT = getattr(settings, 'API_PROFILE_CACHE_TIMEOUT', 300)
+USER_LIST_CACHE_TIMEOUT = getattr(settings, 'API_USER_LIST_CACHE_TIMEOUT', 60)
+TOKEN_CACHE_TIMEOUT = getattr(settings, 'API_TOKEN_CACHE_TIMEOUT', 60)
+
+# how long an expired entry may still be served while it is recomputed
+STALE_TIMEOUT = getattr(settings, 'API_CACHE_STALE_TIMEOUT', 30)
+
+# how long a worker waits for another one computing the same entry
+LOCK_TIMEOUT = getattr(settings, 'API_CACHE_LOCK_TIMEOUT', 10)
+
+# a lock per key being computed in the process, with the number of threads
+# holding or waiting for it, dropped once none is left
+_local_locks = {}
+_local_locks_lock = threading.Lock()
+
+
+def _acquire_local_lock(key, blocking=True):
+    """
+    Acquires the lock of `key` in the process. Returns False if it is held
+    and `blocking` is false. Keys never wait on each other.
+    """
+    with _local_locks_lock:
+        lock, count = _local_locks.get(key, (None, 0))
+        if lock is None:
+            lock = threading.Lock()
+        _local_locks[key] = (lock, count + 1)
+
+    if lock.acquire(blocking):
+        return True
+
+    _forget_local_lock(key)
+    return False
+
+
+def _forget_local_lock(key):
+    with _local_locks_lock:
+        lock, count = _local_locks[key]
+        if count > 1:
+            _local_locks[key] = (lock, count - 1)
+        else:
+            del _local_locks[key]
+
+
+def _release_local_lock(key):
+    _local_locks[key][0].release()
+    _forget_local_lock(key)
+
+
+def _lock_key(key):
+    return '%s:lock' % key
+
+
+def _set_entry(key, value, timeout):
+    # entries outlive their freshness so that they can be served stale
+    cache.set(key, (value, time.time() + timeout), timeout + STALE_TIMEOUT)
+    return value
+
+
+def get_or_compute(key, compute, timeout):
+    """
+    Returns the cached value of `key`, calling `compute` to refresh it.
+
+    Only one caller recomputes a given key at a time: a lock per key in the
+    process, plus a lock entry in the cache across processes. When the
+    entry is merely expired, the others keep getting the previous value
+    while it is recomputed. When there is no entry, they wait for it up to
+    `LOCK_TIMEOUT` seconds before computing it themselves.
+    """
+    entry = cache.get(key)
+
+    if entry is not None:
+        value, fresh_until = entry
+        if time.time() < fresh_until:
+            return value
+
+        if not _acquire_local_lock(key, blocking=False):
+            return value
+
+        try:
+            if not cache.add(_lock_key(key), 1, LOCK_TIMEOUT):
+                return value
+            try:
+                return _set_entry(key, compute(), timeout)
+            finally:
+                cache.delete(_lock_key(key))
+        finally:
+            _release_local_lock(key)
+
+    _acquire_local_lock(key)
+    try:
+        deadline = time.time() + LOCK_TIMEOUT
+
+        while not cache.add(_lock_key(key), 1, LOCK_TIMEOUT):
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+            if time.time() > deadline:
+                # the other worker is stuck, compute without the lock
+                return _set_entry(key, compute(), timeout)
+            time.sleep(0.05)
+
+        try:
+            # computed by another worker while acquiring the lock
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+            return _set_entry(key, compute(), timeout)
+        finally:
+            cache.delete(_lock_key(key))
+    finally:
+        _release_local_lock(key)
+
+
+def _get_version(key):
+    """
+    Returns the version stamp stored under `key`.
+
+    A missing stamp is seeded with the current time rather than a counter
+    so that entries written under an evicted stamp are never read again.
+    """
+    version = cache.get(key)
+
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+
+    return version
+
+
+def _bump_version(key):
+    """
+    Bumps the version stamp stored under `key`. Entries cached under the
+    previous stamp are simply never read again and expire on their own.
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000), None)
+
+
+def _profile_version_key(user_id):
+    return 'api:profile:version:%s' % user_id
+
+
+def get_profile_version(user_id):
+    return _get_version(_profile_version_key(user_id))
+
+
+def get_profile_data(user_id, build):
+    """
+    Returns the serialized profile of the user, calling `build` to
+    serialize it only if there is no entry for the current version.
+    """
+    key = 'api:profile:%s:%s' % (user_id, get_profile_version(user_id))
+    return get_or_compute(key, lambda: dict(build()), PROFILE_CACHE_TIMEOUT)
+
+
+def invalidate_profile(user_id):
+    _bump_version(_profile_version_key(user_id))
+
+
+USER_LIST_VERSION_KEY = 'api:users:version'
+
+
+def get_user_list_data(variant, build):
+    """
+    Returns the serialized user list, `variant` telling apart the lists
+    built with different serializers.
+    """
+    key = 'api:users:%s:%s' % (variant, _get_version(USER_LIST_VERSION_KEY))
+    return get_or_compute(key, lambda: list(build()),
+                          USER_LIST_CACHE_TIMEOUT)
+
+
+def invalidate_user_list():
+    _bump_version(USER_LIST_VERSION_KEY)
+
+
+def token_cache_key(token):
+    # tokens are hashed so that they cannot be read from the keys, and so
+    # that the key is valid for any cache backend
+    return 'api:token:%s' % hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def invalidate_tokens(tokens):
+    cache.delete_many([token_cache_key(token) for token in tokens])
@@ -0,0 +1,66 @@
+"""
+Streaming export of the user list as CSV or NDJSON.
+
+Users are read in primary key order with keyset pagination, one chunk at a
+time, so memory use does not grow with the table and an export can resume
+after the last exported id.
+"""
+import csv
+import io
+import json
+
+from django.contrib.auth.models import User
+
+
+# the readable fields of AccountSerializer, plus the id to resume from
+EXPORT_FIELDS = ('id', 'email', 'first_name', 'last_name')
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def iter_user_chunks(since=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields lists of user rows with an id greater than `since`.
+    """
+    last_id = since or 0
+
+    while True:
+        rows = list(User.objects.filter(pk__gt=last_id)
+                                .order_by('pk')
+                                .values_list(*EXPORT_FIELDS)[:chunk_size])
+        if not rows:
+            return
+
+        yield rows
+        last_id = rows[-1][0]
+
+
+def csv_chunks(chunks, header=True):
+    if header:
+        yield ','.join(EXPORT_FIELDS) + '\r\n'
+
+    for rows in chunks:
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        yield buf.getvalue()
+
+
+def ndjson_chunks(chunks, header=True):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n'
+                      for row in rows)
+
+
+FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'ndjson': (ndjson_chunks, 'application/x-ndjson'),
+}
+
+
+def export_users(output_format, since=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Returns an iterator of strings with the users in the given format.
+    The CSV header is left out when resuming.
+    """
+    writer, content_type = FORMATS[output_format]
+    return writer(iter_user_chunks(since, chunk_size), header=since is None)
@@ -0,0 +1,88 @@
+"""
+Password hashing tuned to the hardware, see the `calibrate_hashers`
+management command.
+
+Django rehashes a password when its user logs in successfully and the
+hash was made with other parameters than the ones configured, so changing
+`API_PBKDF2_ITERATIONS` upgrades (or downgrades) the hashes over time.
+"""
+import math
+import time
+
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """
+    The default PBKDF2 hasher of Django, with the number of iterations
+    taken from `API_PBKDF2_ITERATIONS` when set. Replaces Django's in
+    `PASSWORD_HASHERS`, as both read the `pbkdf2_sha256` hashes.
+    """
+
+    @property
+    def iterations(self):
+        return getattr(settings, 'API_PBKDF2_ITERATIONS', None) or \
+            hashers.PBKDF2PasswordHasher.iterations
+
+
+BENCHMARK_PASSWORD = 'correct horse battery staple'
+
+
+def benchmark(hasher, rounds=5):
+    """
+    Returns the median duration in seconds of hashing a password with the
+    hasher. Raises ValueError if the library of the hasher is missing.
+    """
+    salt = hasher.salt()
+    durations = []
+
+    for i in range(rounds):
+        start = time.perf_counter()
+        hasher.encode(BENCHMARK_PASSWORD, salt)
+        durations.append(time.perf_counter() - start)
+
+    return sorted(durations)[len(durations) // 2]
+
+
+def get_parameters(hasher):
+    """
+    Returns the work factors of the hasher, as a dict.
+    """
+    if isinstance(hasher, hashers.PBKDF2PasswordHasher):
+        return {'iterations': hasher.iterations}
+    if isinstance(hasher, hashers.BCryptSHA256PasswordHasher):
+        return {'rounds': hasher.rounds}
+    if isinstance(hasher, hashers.Argon2PasswordHasher):
+        return {'time_cost': hasher.time_cost,
+                'memory_cost': hasher.memory_cost,
+                'parallelism': hasher.parallelism}
+    return {}
+
+
+def recommend(hasher, duration, target):
+    """
+    Returns the work factors making the hasher take about `target` seconds,
+    given that it took `duration` seconds with the current ones, or None
+    for hashers without a work factor.
+
+    The duration grows linearly with PBKDF2 iterations and Argon2 time
+    cost, and doubles with each bcrypt round.
+    """
+    parameters = get_parameters(hasher)
+    ratio = target / duration
+
+    if 'iterations' in parameters:
+        # rounded to a thousand, and at least that much
+        iterations = int(round(parameters['iterations'] * ratio / 1000.0))
+        parameters['iterations'] = max(iterations, 1) * 1000
+    elif 'rounds' in parameters:
+        rounds = parameters['rounds'] + int(round(math.log(ratio, 2)))
+        parameters['rounds'] = min(max(rounds, 4), 31)
+    elif 'time_cost' in parameters:
+        time_cost = int(round(parameters['time_cost'] * ratio))
+        parameters['time_cost'] = max(time_cost, 1)
+    else:
+        return None
+
+    return parameters
@@ -0,0 +1,263 @@
+"""
+Bulk import of users from CSV or NDJSON, e.g. when migrating from a legacy
+system.
+
+Records are validated with the field rules of `AccountSerializer` a batch
+at a time: the per-row rules run in Python and the e-mail uniqueness check
+is a single query per batch. Valid rows are inserted with `bulk_create`.
+Passwords may be given already hashed (`password_hash`) in any format
+known to the configured password hashers, which skips the expensive
+hashing of raw passwords.
+"""
+import csv
+import itertools
+import json
+
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, transaction
+
+from rest_framework import serializers
+from rest_framework.fields import get_error_detail
+from rest_framework.settings import api_settings
+
+from .cache import invalidate_user_list
+from .models import UserChange
+from .serializers import AccountSerializer, EMAIL_TAKEN_MESSAGE
+from .validators import (UniqueEmailValidator, annotate_email,
+                         normalize_email)
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+TRUE_VALUES = ('1', 'true', 'yes', 't', 'y')
+
+
+def read_csv(stream):
+    return csv.DictReader(stream)
+
+
+class MalformedRecord(object):
+    """
+    Stands for a record that could not be parsed, so that it is rejected
+    with its number instead of stopping the import.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def read_ndjson(stream):
+    for line in stream:
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield MalformedRecord('Invalid JSON: %s' % e)
+            continue
+
+        if isinstance(record, dict):
+            yield record
+        else:
+            yield MalformedRecord('Invalid data. Expected an object, but '
+                                  'got %s.' % type(record).__name__)
+
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+
+class UserImporter(object):
+    """
+    Validates and inserts user records in batches. Each record is a dict
+    with `email`, `first_name`, `last_name`, `is_active`, and either
+    `password` or `password_hash`.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+
+        fields = AccountSerializer().fields
+        self.email_field = fields['email']
+        self.name_fields = (fields['first_name'], fields['last_name'])
+        self.password_field = fields['password']
+
+        # uniqueness is checked once per batch instead of once per row
+        self.email_validators = [
+            validator for validator in self.email_field.validators
+            if not isinstance(validator, UniqueEmailValidator)
+        ]
+
+    def run_field(self, field, value, validators=None):
+        """
+        Converts and validates the value like the serializer field does,
+        with `validators` instead of the field's when given.
+        """
+        value = field.to_internal_value(value)
+        errors = []
+
+        for validator in (field.validators if validators is None
+                          else validators):
+            try:
+                validator(value)
+            except serializers.ValidationError as e:
+                errors.extend(e.detail)
+            except DjangoValidationError as e:
+                # e.g. the EmailValidator of Django
+                errors.extend(get_error_detail(e))
+
+        if errors:
+            raise serializers.ValidationError(errors)
+
+        return value
+
+    def validate_record(self, record):
+        """
+        Returns a `User` built from the record. Raises a `ValidationError`
+        with the errors per field otherwise.
+        """
+        if isinstance(record, MalformedRecord):
+            raise serializers.ValidationError(
+                {api_settings.NON_FIELD_ERRORS_KEY: [record.error]})
+
+        data = {}
+        errors = {}
+
+        email = record.get('email')
+        if not email:
+            errors['email'] = [self.email_field.error_messages['required']]
+        else:
+            try:
+                data['email'] = self.run_field(self.email_field, email,
+                                               self.email_validators)
+            except serializers.ValidationError as e:
+                errors['email'] = e.detail
+
+        for field in self.name_fields:
+            value = record.get(field.field_name)
+            try:
+                data[field.field_name] = \
+                    self.run_field(field, value) if value else ''
+            except serializers.ValidationError as e:
+                errors[field.field_name] = e.detail
+
+        password_hash = record.get('password_hash')
+        password = record.get('password')
+
+        if password_hash:
+            try:
+                identify_hasher(password_hash)
+            except ValueError:
+                errors['password_hash'] = ['Unknown password hash format.']
+            data['password'] = password_hash
+        elif password:
+            try:
+                data['password'] = self.run_field(self.password_field,
+                                                  password)
+            except serializers.ValidationError as e:
+                errors['password'] = e.detail
+        else:
+            errors['password'] = [
+                self.password_field.error_messages['required']]
+
+        if errors:
+            raise serializers.ValidationError(errors)
+
+        if not password_hash:
+            # only hash passwords of records that are otherwise valid
+            data['password'] = make_password(data['password'])
+
+        is_active = record.get('is_active', True)
+        if not isinstance(is_active, bool):
+            is_active = str(is_active).strip().lower() in TRUE_VALUES
+
+        return User(username=data['email'], is_active=is_active, **data)
+
+    def validate_batch(self, records):
+        """
+        Validates a list of `(number, record)` pairs. Returns the valid
+        users and a list of `(number, errors)` for the rejected records.
+        """
+        users = []
+        rejected = []
+
+        for number, record in records:
+            try:
+                users.append((number, self.validate_record(record)))
+            except serializers.ValidationError as e:
+                rejected.append((number, e.detail))
+
+        emails = set(normalize_email(user.email) for number, user in users)
+        taken = set(
+            annotate_email(User.objects.all())
+            .filter(email_lower__in=emails)
+            .values_list('email_lower', flat=True)
+        ) if emails else set()
+
+        valid = []
+        for number, user in users:
+            email = normalize_email(user.email)
+            if email in taken:
+                rejected.append((number, {'email': [EMAIL_TAKEN_MESSAGE]}))
+            else:
+                # also catches duplicates within the batch
+                taken.add(email)
+                valid.append((number, user))
+
+        return valid, rejected
+
+    def load(self, users):
+        """
+        Inserts the users in one statement. If another process inserted a
+        conflicting user in the meantime, falls back to inserting the users
+        one by one and returns the conflicting ones as rejected.
+        """
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create([user for number, user in users])
+
+                # bulk_create skips the signals recording user changes
+                UserChange.objects.record(
+                    User.objects.filter(
+                        username__in=[user.username for number, user in users]
+                    ).values_list('pk', flat=True),
+                    UserChange.UPSERT)
+
+            invalidate_user_list()
+            return []
+        except IntegrityError:
+            pass
+
+        rejected = []
+        for number, user in users:
+            try:
+                with transaction.atomic():
+                    user.save()
+            except IntegrityError:
+                rejected.append((number, {'email': [EMAIL_TAKEN_MESSAGE]}))
+        return rejected
+
+    def run(self, records, start=0):
+        """
+        Imports the records, skipping the first `start` ones. Yields a
+        `(position, imported, rejected)` tuple after each batch, where
+        `position` is the number of records processed so far and can be
+        used as the `start` of a resumed import.
+        """
+        numbered = itertools.islice(enumerate(records, start=1), start, None)
+
+        while True:
+            batch = list(itertools.islice(numbered, self.batch_size))
+            if not batch:
+                return
+
+            valid, rejected = self.validate_batch(batch)
+            conflicts = self.load(valid)
+
+            yield (batch[-1][0], len(valid) - len(conflicts),
+                   sorted(rejected + conflicts, key=lambda r: r[0]))
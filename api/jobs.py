@@ -0,0 +1,286 @@
+"""
+A small database-backed job queue for side effects that do not need to run
+inside the request, e.g. sending e-mails.
+
+Jobs are plain functions registered with the `job` decorator in a `tasks`
+module of an installed app. Request handlers call `enqueue` and the
+`runjobs` management command claims and executes them. Jobs registered
+with `every` are also queued periodically by `runjobs` (see
+`schedule_periodic`), e.g. housekeeping that must not run per request.
+"""
+from datetime import timedelta
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Avg, Count, F, Max
+from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules
+
+from .models import Job
+
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+JOBS_EAGER = getattr(settings, 'API_JOBS_EAGER', False)
+JOBS_RETRY_DELAY = getattr(settings, 'API_JOBS_RETRY_DELAY', 30)
+JOBS_STALE_TIMEOUT = getattr(settings, 'API_JOBS_STALE_TIMEOUT', 600)
+
+
+def get_retention_days():
+    return getattr(settings, 'API_JOBS_RETENTION_DAYS', 7)
+
+
+_discovered = False
+
+
+def job(name=None, max_attempts=3, every=None):
+    """
+    Registers the decorated function as a job. Job arguments are passed as
+    keyword arguments and must be JSON serializable. A job given `every`
+    (in seconds) is queued without arguments that often by `runjobs`.
+    """
+    def decorator(func):
+        func.job_name = name or '%s.%s' % (func.__module__, func.__name__)
+        func.max_attempts = max_attempts
+        func.every = every
+        registry[func.job_name] = func
+        return func
+    return decorator
+
+
+def discover():
+    global _discovered
+
+    if not _discovered:
+        autodiscover_modules('tasks')
+        _discovered = True
+
+
+def get_job_function(name):
+    if name not in registry:
+        discover()
+
+    return registry[name]
+
+
+def enqueue(func, run_at=None, **kwargs):
+    """
+    Queues a call of the job function `func` with the given keyword
+    arguments. Runs it right away when `API_JOBS_EAGER` is set.
+    """
+    created = Job.objects.create(
+        name=func.job_name,
+        payload=json.dumps(kwargs),
+        max_attempts=func.max_attempts,
+        run_at=run_at or timezone.now(),
+    )
+
+    if JOBS_EAGER:
+        claimed = _claim_ids([created.pk], get_worker_id())
+        for instance in Job.objects.filter(pk__in=claimed):
+            run_job(instance)
+
+    return created
+
+
+def get_worker_id():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def _claim_ids(ids, worker_id):
+    """
+    Marks the given queued jobs as running. Each job is only moved out of
+    the queued state once, so concurrent workers never claim the same job.
+    """
+    fields = {
+        'status': Job.RUNNING,
+        'locked_by': worker_id,
+        'started': timezone.now(),
+        'attempts': F('attempts') + 1,
+    }
+
+    if connection.vendor == 'postgresql':
+        # the rows are already locked by `SELECT ... FOR UPDATE SKIP LOCKED`
+        Job.objects.filter(pk__in=ids).update(**fields)
+        return list(ids)
+
+    return [pk for pk in ids
+            if Job.objects.filter(pk=pk, status=Job.QUEUED)
+                          .update(**fields)]
+
+
+def claim(worker_id, limit):
+    """
+    Claims up to `limit` jobs that are due and returns them.
+
+    PostgreSQL skips rows locked by other workers, so concurrent workers
+    never wait on each other. Other backends (e.g. SQLite) fall back to a
+    conditional UPDATE per candidate, where losing a race just means the
+    job is claimed by another worker.
+    """
+    now = timezone.now()
+
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT id FROM %s WHERE status = %%s AND run_at <= %%s '
+                    'ORDER BY run_at LIMIT %%s FOR UPDATE SKIP LOCKED'
+                    % connection.ops.quote_name(Job._meta.db_table),
+                    [Job.QUEUED, now, limit])
+                ids = [row[0] for row in cursor.fetchall()]
+        else:
+            ids = list(Job.objects.filter(status=Job.QUEUED, run_at__lte=now)
+                                  .order_by('run_at')
+                                  .values_list('pk', flat=True)[:limit])
+
+        ids = _claim_ids(ids, worker_id)
+
+    return list(Job.objects.filter(pk__in=ids).order_by('run_at'))
+
+
+def run_job(instance):
+    """
+    Executes a claimed job and records the outcome and timing. Failed jobs
+    are queued again with an exponential backoff until `max_attempts`.
+    """
+    started = time.time()
+    fields = {}
+
+    try:
+        func = get_job_function(instance.name)
+        func(**json.loads(instance.payload))
+    except Exception:
+        fields['last_error'] = traceback.format_exc()
+
+        if instance.attempts < instance.max_attempts:
+            delay = JOBS_RETRY_DELAY * 2 ** (instance.attempts - 1)
+            fields['status'] = Job.QUEUED
+            fields['run_at'] = timezone.now() + timedelta(seconds=delay)
+        else:
+            fields['status'] = Job.FAILED
+    else:
+        fields['status'] = Job.DONE
+        fields['last_error'] = ''
+
+    fields['duration'] = time.time() - started
+    fields['finished'] = timezone.now()
+
+    Job.objects.filter(pk=instance.pk).update(**fields)
+
+    logger.info('%s #%s %s in %.3fs (attempt %s, waited %.3fs)',
+                instance.name, instance.pk, fields['status'],
+                fields['duration'], instance.attempts,
+                (instance.started - instance.run_at).total_seconds())
+
+    return fields['status']
+
+
+def execute_job(pk):
+    """
+    Runs the job with the given primary key. Used as the entry point of
+    the `runjobs` worker pool, which may run it in another thread or
+    process, so the database connection is closed afterwards.
+    """
+    try:
+        return run_job(Job.objects.get(pk=pk))
+    finally:
+        connection.close()
+
+
+def run_pending(limit=100):
+    """
+    Claims and runs due jobs in the current thread until none is left.
+    Returns the number of jobs run.
+    """
+    worker_id = get_worker_id()
+    count = 0
+
+    while True:
+        claimed = claim(worker_id, limit)
+        if not claimed:
+            return count
+
+        for instance in claimed:
+            run_job(instance)
+        count += len(claimed)
+
+
+def requeue_stale(timeout=JOBS_STALE_TIMEOUT):
+    """
+    Queues again jobs whose worker died while running them, unless they
+    used up their attempts: a job crashing its worker is not retried
+    forever. Returns the number of jobs queued again.
+    """
+    now = timezone.now()
+    stale = Job.objects.filter(status=Job.RUNNING,
+                               started__lt=now - timedelta(seconds=timeout))
+
+    stale.filter(attempts__gte=F('max_attempts')).update(
+        status=Job.FAILED, locked_by='', finished=now,
+        last_error='The worker stopped while running the job.')
+
+    return stale.filter(attempts__lt=F('max_attempts')) \
+                .update(status=Job.QUEUED, locked_by='')
+
+
+def schedule_periodic():
+    """
+    Queues the periodic jobs not queued in the last `every` seconds, and
+    returns them. Called regularly by every `runjobs` worker, so a job is
+    queued once per period whatever the number of workers.
+    """
+    discover()
+    now = timezone.now()
+    queued = []
+
+    for func in registry.values():
+        if not func.every:
+            continue
+
+        since = now - timedelta(seconds=func.every)
+        if not Job.objects.filter(name=func.job_name,
+                                  created__gt=since).exists():
+            queued.append(enqueue(func))
+
+    return queued
+
+
+def purge(days=None, batch_size=10000):
+    """
+    Deletes the jobs done or failed more than `days` ago,
+    `API_JOBS_RETENTION_DAYS` by default, in batches. Returns the number
+    of jobs deleted.
+    """
+    if days is None:
+        days = get_retention_days()
+
+    finished = Job.objects.filter(
+        status__in=(Job.DONE, Job.FAILED),
+        finished__lt=timezone.now() - timedelta(days=days))
+    deleted = 0
+
+    while True:
+        ids = list(finished.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += Job.objects.filter(pk__in=ids).delete()[0]
+
+
+def job_metrics():
+    """
+    Returns the job count and timing in seconds per job name and status.
+    """
+    return Job.objects.values('name', 'status') \
+                      .annotate(count=Count('pk'),
+                                avg_duration=Avg('duration'),
+                                max_duration=Max('duration')) \
+                      .order_by('name', 'status')
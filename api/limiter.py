@@ -0,0 +1,284 @@
+"""
+Adaptive concurrency limits for the API views.
+
+Each view of `api.urls` belongs to a priority class (see
+`API_CONCURRENCY_CLASSES`), and each class has its own limit on the
+requests running at once in the process. The limits adapt to the latency
+of the class (AIMD): a request slower than the latency target of its
+class, or failing, cuts the limit by `backoff`, while a fast one raises it
+by one as long as the limit is being used. Requests over the limit are
+rejected right away with a 503 and a Retry-After header, instead of
+piling up in the workers.
+
+So when the database or the SMTP server slows down, the expensive writes
+(registration, login) are shed early while cheap reads keep their own
+limit and keep flowing. Limits are per process, and only bound requests
+with threaded workers.
+"""
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+
+from .jobs import get_worker_id
+
+
+DEFAULT_CLASSES = {
+    'api_register': 'write',
+    'api_login': 'write',
+    'api_verify_email': 'write',
+    'api_change_password': 'write',
+    'api_batch': 'write',
+    'api_users_export': 'write',
+    'api_users': 'read',
+    'api_user_changes': 'read',
+    'api_profile': 'read',
+}
+
+# latency targets are in seconds
+DEFAULT_LIMITS = {
+    'write': {'initial': 10, 'min': 1, 'max': 50, 'latency': 1.0},
+    'read': {'initial': 50, 'min': 5, 'max': 200, 'latency': 0.25},
+}
+
+BACKOFF = getattr(settings, 'API_CONCURRENCY_BACKOFF', 0.9)
+
+# how often each process publishes its metrics to the cache, in seconds
+PUBLISH_INTERVAL = 5
+
+# each process publishes its metrics in a slot of its own, claimed with
+# `cache.add`, so that processes never overwrite each other's
+MAX_PROCESSES = 256
+SLOT_KEY = 'api:limits:slot:%s'
+
+
+def get_classes():
+    return getattr(settings, 'API_CONCURRENCY_CLASSES', DEFAULT_CLASSES)
+
+
+def is_enabled():
+    return getattr(settings, 'API_CONCURRENCY_LIMITS_ENABLED', True)
+
+
+class AIMDLimiter(object):
+    """
+    A concurrency limit that grows by one while requests are fast and the
+    limit is used, and shrinks by `backoff` when a request is slow or
+    fails.
+    """
+
+    def __init__(self, initial, min, max, latency, backoff=BACKOFF):
+        self.limit = float(initial)
+        self.min_limit = min
+        self.max_limit = max
+        self.latency_target = latency
+        self.backoff = backoff
+
+        self.inflight = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.latency = None  # moving average, in seconds
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.inflight >= int(self.limit):
+                self.rejected += 1
+                return False
+
+            self.inflight += 1
+            self.accepted += 1
+            return True
+
+    def release(self, latency, failed=False):
+        with self.lock:
+            # only a used limit is known to be safe to raise
+            used = self.inflight * 2 >= self.limit
+            self.inflight -= 1
+
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.9 * self.latency + 0.1 * latency
+
+            if failed or latency > self.latency_target:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            elif used:
+                self.limit = min(self.max_limit, self.limit + 1)
+
+    def get_retry_after(self):
+        # the requests running now should be done by then
+        return max(1, int(math.ceil(self.latency or 0)))
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                'limit': int(self.limit),
+                'inflight': self.inflight,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'latency': self.latency,
+            }
+
+
+limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(priority):
+    limiter = limiters.get(priority)
+
+    if limiter is None:
+        with _limiters_lock:
+            limiter = limiters.get(priority)
+            if limiter is None:
+                options = getattr(settings, 'API_CONCURRENCY_LIMITS',
+                                  DEFAULT_LIMITS)[priority]
+                limiter = limiters[priority] = AIMDLimiter(**options)
+
+    return limiter
+
+
+def get_metrics():
+    """
+    Returns the metrics of the limiters of the process per class.
+    """
+    return dict((priority, limiter.get_metrics())
+                for priority, limiter in sorted(limiters.items()))
+
+
+_next_publish = 0
+_slot = None
+
+
+def _store(value):
+    global _slot
+
+    timeout = PUBLISH_INTERVAL * 3
+
+    if _slot is not None:
+        key = SLOT_KEY % _slot
+        current = cache.get(key)
+
+        if current is not None and current['process'] == value['process']:
+            cache.set(key, value, timeout)
+            return
+        if current is None and cache.add(key, value, timeout):
+            return
+
+    # no slot yet, or it expired and was claimed by another process
+    for slot in range(MAX_PROCESSES):
+        if cache.add(SLOT_KEY % slot, value, timeout):
+            _slot = slot
+            return
+
+
+def publish_metrics():
+    """
+    Copies the metrics of the process to the cache, at most every
+    `PUBLISH_INTERVAL` seconds, so that `get_all_metrics` sees them.
+    """
+    global _next_publish
+
+    now = time.time()
+    if now < _next_publish:
+        return
+    _next_publish = now + PUBLISH_INTERVAL
+
+    _store({'process': get_worker_id(), 'time': now,
+            'classes': get_metrics()})
+
+
+def get_all_metrics():
+    """
+    Returns the latest metrics of every process that published them in
+    the last `PUBLISH_INTERVAL * 3` seconds.
+    """
+    slots = cache.get_many([SLOT_KEY % slot for slot in range(MAX_PROCESSES)])
+
+    return dict((value['process'], {'time': value['time'],
+                                    'classes': value['classes']})
+                for value in slots.values())
+
+
+class StreamingContent(object):
+    """
+    The body of a streaming response, releasing the slot of the request
+    when the response is closed rather than when the view returns, so that
+    the limit and the latency cover the streaming.
+    """
+
+    def __init__(self, content, limiter, start):
+        self.content = content
+        self.limiter = limiter
+        self.start = start
+        self.failed = False
+        self.released = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.content:
+                yield chunk
+        except Exception:
+            self.failed = True
+            raise
+
+    def close(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release(time.time() - self.start,
+                                 failed=self.failed)
+            publish_metrics()
+
+
+class ConcurrencyLimitMiddleware(MiddlewareMixin):
+    """
+    Applies the concurrency limit of the class of the view to the request.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not is_enabled() or request.resolver_match is None:
+            return None
+
+        priority = get_classes().get(request.resolver_match.url_name)
+        if priority is None:
+            return None
+
+        limiter = get_limiter(priority)
+
+        if not limiter.acquire():
+            publish_metrics()
+
+            response = JsonResponse(
+                {'detail': 'The server is overloaded, try again later.'},
+                status=503)
+            response['Retry-After'] = str(limiter.get_retry_after())
+            return response
+
+        request._concurrency_limit = (limiter, time.time())
+        return None
+
+    def process_response(self, request, response):
+        acquired = getattr(request, '_concurrency_limit', None)
+
+        if acquired is None:
+            return response
+
+        del request._concurrency_limit
+        limiter, start = acquired
+
+        if response.status_code < 500 and \
+                getattr(response, 'streaming', False):
+            # closed by the server once the body is sent, or dropped
+            response.streaming_content = StreamingContent(
+                response.streaming_content, limiter, start)
+        else:
+            limiter.release(time.time() - start,
+                            failed=response.status_code >= 500)
+            publish_metrics()
+
+        return response
@@ -0,0 +1,97 @@
+import os
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.core.management.base import BaseCommand, CommandError
+
+from api.hashers import (PBKDF2PasswordHasher, benchmark, get_parameters,
+                         recommend)
+
+
+ENV_VARIABLE = 'PBKDF2_ITERATIONS'
+
+
+def format_parameters(parameters):
+    return ', '.join('%s=%s' % item for item in sorted(parameters.items()))
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the password hashers of PASSWORD_HASHERS on this '
+            'host and recommends work factors for the target duration of a '
+            'hash. With --write, saves the recommended PBKDF2 iterations to '
+            'the .env file.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-ms', type=float,
+                            default=getattr(settings,
+                                            'API_PASSWORD_HASH_TARGET_MS',
+                                            250),
+                            help='Target duration of a hash, in '
+                                 'milliseconds.')
+        parser.add_argument('--rounds', type=int, default=5,
+                            help='Hashes timed per hasher, the median is '
+                                 'kept.')
+        parser.add_argument('--write', action='store_true',
+                            help='Writes %s to the .env file.' %
+                                 ENV_VARIABLE)
+        parser.add_argument('--env-file', default='.env')
+
+    def handle(self, *args, **options):
+        target = options['target_ms'] / 1000.0
+        iterations = None
+
+        for hasher in hashers.get_hashers():
+            try:
+                duration = benchmark(hasher, options['rounds'])
+            except ValueError:
+                self.stdout.write('%s: library not installed' %
+                                  hasher.algorithm)
+                continue
+
+            recommended = recommend(hasher, duration, target)
+
+            # a login costs one hash, so this is the login capacity of a
+            # core with this hasher
+            self.stdout.write('%s: %.1f ms per hash, %.1f hashes/s per core '
+                              '(%s)' % (hasher.algorithm, duration * 1000,
+                                        1 / duration,
+                                        format_parameters(
+                                            get_parameters(hasher))))
+            if recommended is not None:
+                self.stdout.write('  recommended for %g ms: %s' % (
+                    options['target_ms'], format_parameters(recommended)))
+
+            if isinstance(hasher, PBKDF2PasswordHasher):
+                iterations = recommended['iterations']
+
+        if iterations is None:
+            if options['write']:
+                raise CommandError('api.hashers.PBKDF2PasswordHasher is not '
+                                   'in PASSWORD_HASHERS.')
+            return
+
+        if iterations < hashers.PBKDF2PasswordHasher.iterations:
+            self.stderr.write('Warning: %s iterations is less than the '
+                              'Django default of %s, consider a larger '
+                              'target.' % (
+                                  iterations,
+                                  hashers.PBKDF2PasswordHasher.iterations))
+
+        if options['write']:
+            self.write_env(options['env_file'], iterations)
+            self.stdout.write('Wrote %s=%s to %s, restart the server to '
+                              'apply it. Passwords are rehashed as their '
+                              'users log in.' % (ENV_VARIABLE, iterations,
+                                                 options['env_file']))
+
+    def write_env(self, path, iterations):
+        lines = []
+        if os.path.exists(path):
+            with open(path) as env_file:
+                lines = [line for line in env_file.read().splitlines()
+                         if not line.startswith(ENV_VARIABLE + '=')]
+
+        lines.append('%s=%s' % (ENV_VARIABLE, iterations))
+
+        with open(path, 'w') as env_file:
+            env_file.write('\n'.join(lines) + '\n')
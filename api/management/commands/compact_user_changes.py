@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from api.models import UserChange
+
+
+class Command(BaseCommand):
+    help = ('Deletes the user changes superseded by a later change of the '
+            'same user.')
+
+    def handle(self, *args, **options):
+        deleted = UserChange.objects.compact()
+        self.stdout.write('Deleted %s superseded change(s)' % deleted)
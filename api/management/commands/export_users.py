@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from api.export import DEFAULT_CHUNK_SIZE, FORMATS, export_users
+
+
+class Command(BaseCommand):
+    help = 'Exports the users as CSV or NDJSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(FORMATS),
+                            default='csv', dest='output_format')
+        parser.add_argument('--output',
+                            help='File to write to, defaults to stdout. '
+                                 'Appended to when resuming.')
+        parser.add_argument('--since', type=int,
+                            help='Resume after the user with this id.')
+        parser.add_argument('--chunk-size', type=int,
+                            default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        chunks = export_users(options['output_format'],
+                              since=options['since'],
+                              chunk_size=options['chunk_size'])
+
+        if options['output']:
+            mode = 'a' if options['since'] is not None else 'w'
+            with open(options['output'], mode, newline='') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            self.stdout.flush()
@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import sharding
+from api.imports import DEFAULT_BATCH_SIZE, READERS, UserImporter
+
+
+class Command(BaseCommand):
+    help = ('Imports users from CSV or NDJSON. Records need an email and '
+            'either a password or a password_hash, and may have a '
+            'first_name, last_name and is_active.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, - for stdin.')
+        parser.add_argument('--format', choices=sorted(READERS),
+                            dest='input_format',
+                            help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int,
+                            default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--checkpoint',
+                            help='File recording the progress. If it '
+                                 'exists, the import resumes from it.')
+        parser.add_argument('--errors',
+                            help='File the rejected records are written to '
+                                 'as NDJSON, defaults to stderr.')
+
+    def handle(self, *args, **options):
+        # bulk inserts bypass the shard directory allocating the user ids
+        if sharding.is_enabled():
+            raise CommandError('Importing users is not supported when the '
+                               'users are sharded.')
+
+        path = options['path']
+        input_format = options['input_format']
+
+        if input_format is None:
+            input_format = os.path.splitext(path)[1].lstrip('.').lower()
+            if input_format not in READERS:
+                raise CommandError('Unknown format, use --format.')
+
+        checkpoint = self.read_checkpoint(options['checkpoint'])
+        if checkpoint['position']:
+            self.stdout.write('Resuming after record %s' %
+                              checkpoint['position'])
+
+        errors = open(options['errors'], 'a') if options['errors'] \
+            else self.stderr
+        stream = sys.stdin if path == '-' else open(path, newline='')
+
+        importer = UserImporter(batch_size=options['batch_size'])
+        records = READERS[input_format](stream)
+
+        try:
+            for position, imported, rejected in importer.run(
+                    records, start=checkpoint['position']):
+                for number, detail in rejected:
+                    errors.write(json.dumps({'record': number,
+                                             'errors': detail}) + '\n')
+
+                checkpoint['position'] = position
+                checkpoint['imported'] += imported
+                checkpoint['rejected'] += len(rejected)
+                self.write_checkpoint(options['checkpoint'], checkpoint)
+
+                self.stdout.write('%(position)s records processed, '
+                                  '%(imported)s imported, '
+                                  '%(rejected)s rejected' % checkpoint)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if errors is not self.stderr:
+                errors.close()
+
+    def read_checkpoint(self, path):
+        if path and os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return {'position': 0, 'imported': 0, 'rejected': 0}
+
+    def write_checkpoint(self, path, checkpoint):
+        if not path:
+            return
+
+        # written to a temporary file first so that a crash never leaves a
+        # truncated checkpoint behind
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, path)
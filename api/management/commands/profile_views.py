@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import profiling
+
+
+class Command(BaseCommand):
+    help = ('Controls the sampling profiler of the views in api.views and '
+            'exports the collected stacks.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action',
+                            choices=('enable', 'disable', 'status', 'token',
+                                     'export', 'clear'))
+        parser.add_argument('views', nargs='*',
+                            help='View names, e.g. api.views.LoginView')
+        parser.add_argument('--rate', type=float, default=0.01,
+                            help='Fraction of the requests to profile.')
+        parser.add_argument('--duration', type=int, default=600,
+                            help='Seconds to profile for, or for which the '
+                                 'header token is valid.')
+        parser.add_argument('--format', choices=sorted(profiling.EXPORTERS),
+                            default='collapsed', dest='output_format')
+        parser.add_argument('--output', help='File to export to.')
+
+    def handle(self, *args, **options):
+        views = options['views']
+
+        for view_name in views:
+            if not profiling.is_profilable(view_name):
+                raise CommandError('%s is not a view of %s' % (
+                    view_name, profiling.PROFILED_MODULE))
+
+        action = options['action']
+
+        if action == 'enable':
+            if not views:
+                raise CommandError('Give the views to profile.')
+            profiling.enable(dict((view_name, options['rate'])
+                                  for view_name in views),
+                             options['duration'])
+        elif action == 'disable':
+            profiling.disable()
+        elif action == 'clear':
+            profiling.clear()
+        elif action == 'token':
+            self.stdout.write(profiling.make_token(options['duration']))
+        elif action == 'status':
+            self.stdout.write('Enabled: %s' % profiling.get_config())
+            for view_name in profiling.get_profiled_views():
+                samples = sum(profiling.get_stacks(view_name).values())
+                self.stdout.write('%s: %s samples' % (view_name, samples))
+        elif action == 'export':
+            if len(views) != 1:
+                raise CommandError('Give one view to export.')
+            data = profiling.export(views[0], options['output_format'])
+
+            if options['output']:
+                with open(options['output'], 'w') as f:
+                    f.write(data)
+            else:
+                self.stdout.write(data, ending='')
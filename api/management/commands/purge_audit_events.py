@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from api import audit
+
+
+class Command(BaseCommand):
+    help = ('Deletes the audit events older than the retention period, '
+            'API_AUDIT_RETENTION_DAYS by default.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Deletes the events older than this many '
+                                 'days.')
+
+    def handle(self, *args, **options):
+        deleted = audit.purge(options['days'])
+        self.stdout.write('Deleted %s audit event(s)' % deleted)
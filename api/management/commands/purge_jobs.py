@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from api import jobs
+
+
+class Command(BaseCommand):
+    help = ('Deletes the jobs finished before the retention period, '
+            'API_JOBS_RETENTION_DAYS by default.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Deletes the jobs finished more than this '
+                                 'many days ago.')
+
+    def handle(self, *args, **options):
+        deleted = jobs.purge(options['days'])
+        self.stdout.write('Deleted %s job(s)' % deleted)
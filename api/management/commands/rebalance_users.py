@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from oauth2_provider.models import Application
+
+from api import sharding
+from api.models import UserShard
+
+
+class Command(BaseCommand):
+    help = ('Moves the users that are not on the shard they belong on, '
+            'e.g. after adding a shard, and copies the OAuth2 '
+            'applications to every shard.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only counts the users to move.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not sharding.is_enabled():
+            raise CommandError('The users are not sharded, set '
+                               'USER_SHARD_URLS.')
+
+        if not options['dry_run']:
+            for application in Application.objects.iterator():
+                sharding.replicate_application(application)
+
+        moved = skipped = 0
+
+        entries = sharding.iter_by_pk(UserShard.objects.all(),
+                                      options['batch_size'])
+
+        for entry in entries:
+            target = sharding.get_shard_for(entry.pk)
+            if entry.shard == target:
+                continue
+
+            if options['dry_run']:
+                moved += 1
+            elif sharding.move_user(entry.pk, entry.shard, target):
+                moved += 1
+            else:
+                skipped += 1
+
+        self.stdout.write('%s %s user(s), skipped %s staff or missing '
+                          'user(s)' % ('Would move' if options['dry_run']
+                                       else 'Moved', moved, skipped))
@@ -0,0 +1,92 @@
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api import jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Number of jobs run at the same time.')
+        parser.add_argument('--pool', choices=('thread', 'process'),
+                            default='thread',
+                            help='Run jobs in a thread or a process pool.')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty.')
+        parser.add_argument('--stats', action='store_true',
+                            help='Print job timing metrics and exit.')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            return self.print_stats()
+
+        concurrency = options['concurrency']
+        worker_id = jobs.get_worker_id()
+
+        if options['pool'] == 'process':
+            # forked children must not share the parent's connections, or
+            # closing them after a job would end the parent's session. The
+            # processes are forked on the first submit, so do it now,
+            # before the claims below connect again.
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=concurrency)
+            executor.submit(os.getpid).result()
+        else:
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        self.stdout.write('Worker %s started with %s %s(s)' % (
+            worker_id, concurrency, options['pool']))
+
+        running = set()
+        last_housekeeping = 0
+
+        try:
+            while True:
+                if time.time() - last_housekeeping > 60:
+                    jobs.requeue_stale()
+                    jobs.schedule_periodic()
+                    last_housekeeping = time.time()
+
+                free = concurrency - len(running)
+                claimed = jobs.claim(worker_id, free) if free else []
+
+                for instance in claimed:
+                    running.add(executor.submit(jobs.execute_job, instance.pk))
+
+                if running:
+                    done, running = wait(running,
+                                         timeout=options['interval'],
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future.exception() is not None:
+                            self.stderr.write('Job crashed: %r' %
+                                              future.exception())
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Waiting for %s running job(s)' % len(running))
+        finally:
+            executor.shutdown(wait=True)
+
+    def print_stats(self):
+        row_format = '%-50s %-8s %8s %10s %10s'
+
+        self.stdout.write(row_format % ('name', 'status', 'count',
+                                        'avg (s)', 'max (s)'))
+
+        for row in jobs.job_metrics():
+            self.stdout.write(row_format % (
+                row['name'], row['status'], row['count'],
+                '%.3f' % (row['avg_duration'] or 0),
+                '%.3f' % (row['max_duration'] or 0)))
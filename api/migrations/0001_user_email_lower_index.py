@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import CommandError
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+INDEX_NAME = 'api_user_email_lower_uniq'
+
+# expression and partial indexes are only available on these backends
+SUPPORTED_VENDORS = ('postgresql', 'sqlite')
+
+
+def create_email_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in SUPPORTED_VENDORS:
+        return
+
+    User = apps.get_model('auth', 'User')
+    quote_name = schema_editor.quote_name
+
+    # the index cannot be built while e-mails differ only by case
+    duplicates = list(
+        User.objects.using(schema_editor.connection.alias)
+                    .exclude(email='')
+                    .annotate(email_lower=Lower('email'))
+                    .values('email_lower')
+                    .annotate(count=Count('pk'))
+                    .filter(count__gt=1)
+                    .order_by('email_lower')
+                    .values_list('email_lower', flat=True)
+    )
+    if duplicates:
+        raise CommandError(
+            'These e-mails are used by more than one user, ignoring case: '
+            '%s. Change or merge these users before migrating.' %
+            ', '.join(duplicates))
+
+    # users without an e-mail (e.g. superusers) are left out of the index
+    schema_editor.execute(
+        "CREATE UNIQUE INDEX %s ON %s (LOWER(%s)) WHERE %s <> ''" % (
+            quote_name(INDEX_NAME),
+            quote_name(User._meta.db_table),
+            quote_name('email'),
+            quote_name('email'),
+        )
+    )
+
+
+def drop_email_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in SUPPORTED_VENDORS:
+        return
+
+    schema_editor.execute(
+        'DROP INDEX IF EXISTS %s' % schema_editor.quote_name(INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_email_index, drop_email_index),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def record_existing_users(apps, schema_editor):
+    """
+    Starts the log with an upsert of every existing user, so that syncing
+    from scratch returns the whole user list.
+    """
+    User = apps.get_model('auth', 'User')
+    UserChange = apps.get_model('api', 'UserChange')
+
+    now = django.utils.timezone.now()
+    last_id = 0
+
+    while True:
+        ids = list(User.objects.filter(pk__gt=last_id).order_by('pk')
+                               .values_list('pk', flat=True)[:5000])
+        if not ids:
+            return
+
+        UserChange.objects.bulk_create([
+            UserChange(user_id=pk, kind='upsert', created=now) for pk in ids
+        ])
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserChange',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('user_id', models.IntegerField(db_index=True)),
+                ('kind', models.CharField(choices=[('upsert', 'Created or updated'), ('delete', 'Deleted')], max_length=6)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(record_existing_users, migrations.RunPython.noop),
+    ]
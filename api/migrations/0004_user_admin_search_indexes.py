@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+SEARCH_FIELDS = ('email', 'first_name', 'last_name')
+
+
+def get_index_name(field):
+    return 'api_user_%s_lower_prefix' % field
+
+
+def create_search_indexes(apps, schema_editor):
+    # text_pattern_ops lets PostgreSQL answer LOWER(field) LIKE 'term%'
+    # from the index regardless of the database collation
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    User = apps.get_model('auth', 'User')
+    quote_name = schema_editor.quote_name
+
+    for field in SEARCH_FIELDS:
+        schema_editor.execute(
+            'CREATE INDEX %s ON %s (LOWER(%s) text_pattern_ops)' % (
+                quote_name(get_index_name(field)),
+                quote_name(User._meta.db_table),
+                quote_name(field),
+            )
+        )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for field in SEARCH_FIELDS:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' %
+                              schema_editor.quote_name(get_index_name(field)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_userchange'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
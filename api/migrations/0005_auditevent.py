@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_user_admin_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField(blank=True, null=True)),
+                ('event', models.CharField(choices=[('login', 'Logged in'), ('login_failed', 'Failed to log in'), ('register', 'Registered'), ('verify_email', 'Verified e-mail'), ('change_password', 'Changed password'), ('update_profile', 'Updated profile')], max_length=20)),
+                ('ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('data', models.TextField(default='{}')),
+                ('created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='auditevent',
+            index_together=set([('user_id', 'created')]),
+        ),
+    ]
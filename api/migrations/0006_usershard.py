@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+
+
+def register_existing_users(apps, schema_editor):
+    """
+    Registers the existing users in the directory, on the default database
+    where they are, so that new ids are allocated after theirs.
+    """
+    connection = schema_editor.connection
+    if connection.alias != DEFAULT_DB_ALIAS:
+        return
+
+    User = apps.get_model('auth', 'User')
+    UserShard = apps.get_model('api', 'UserShard')
+
+    last_id = 0
+
+    while True:
+        users = list(User.objects.filter(pk__gt=last_id).order_by('pk')
+                                 .values_list('pk', 'email')[:5000])
+        if not users:
+            break
+
+        UserShard.objects.bulk_create([
+            UserShard(pk=pk, email=email.strip().lower() or None,
+                      shard=DEFAULT_DB_ALIAS)
+            for pk, email in users
+        ])
+        last_id = users[-1][0]
+
+    # explicit ids do not move the sequence on PostgreSQL
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [UserShard]):
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_auditevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserShard',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('email', models.CharField(max_length=254, null=True, unique=True)),
+                ('shard', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.RunPython(register_existing_users, migrations.RunPython.noop),
+    ]
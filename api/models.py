@@ -1,3 +1,187 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class Job(models.Model):
+    """
+    A unit of deferred work, executed by the `runjobs` management command.
+    See `api.jobs` for enqueueing and claiming.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    name = models.CharField(max_length=100)
+    payload = models.TextField(default='{}')  # JSON encoded kwargs
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(default=timezone.now)
+
+    # bookkeeping of the last attempt
+    locked_by = models.CharField(max_length=100, blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)  # in seconds
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        index_together = [('status', 'run_at')]
+
+    def __str__(self):
+        return '%s #%s (%s)' % (self.name, self.pk, self.status)
+
+
+class UserChangeManager(models.Manager):
+    def record(self, user_ids, kind):
+        """
+        Appends a change of the given kind for each user id to the log.
+        Must be called for bulk writes that bypass the model signals.
+        """
+        now = timezone.now()
+        return self.bulk_create([
+            self.model(user_id=user_id, kind=kind, created=now)
+            for user_id in user_ids
+        ])
+
+    def compact(self):
+        """
+        Deletes the changes superseded by a later change of the same user.
+        Only the latest change of a user is needed to bring a client up to
+        date, so the log never outgrows the number of users ever created.
+        """
+        latest = self.values('user_id').annotate(latest=models.Max('seq')) \
+                                       .values('latest')
+        return self.exclude(seq__in=latest).delete()[0]
+
+
+class UserChange(models.Model):
+    """
+    An append-only log of the changes made to users, used to sync clients
+    incrementally. `seq` increases monotonically with each change.
+    """
+    UPSERT = 'upsert'
+    DELETE = 'delete'
+
+    KIND_CHOICES = (
+        (UPSERT, 'Created or updated'),
+        (DELETE, 'Deleted'),
+    )
+
+    seq = models.BigAutoField(primary_key=True)
+    user_id = models.IntegerField(db_index=True)
+    kind = models.CharField(max_length=6, choices=KIND_CHOICES)
+    created = models.DateTimeField(default=timezone.now)
+
+    objects = UserChangeManager()
+
+    def __str__(self):
+        return '#%s %s user %s' % (self.seq, self.kind, self.user_id)
+
+
+class AuditEventQuerySet(models.QuerySet):
+    def for_user(self, user_id):
+        return self.filter(user_id=user_id)
+
+    def between(self, since=None, until=None):
+        """
+        Returns the events created from `since` and before `until`, most
+        recent first.
+        """
+        queryset = self
+        if since is not None:
+            queryset = queryset.filter(created__gte=since)
+        if until is not None:
+            queryset = queryset.filter(created__lt=until)
+        return queryset.order_by('-created', '-pk')
+
+    def purge(self, before, batch_size=10000):
+        """
+        Deletes the events created before `before`, in batches so that
+        the deletion never locks a large part of the table for long.
+        """
+        deleted = 0
+
+        while True:
+            ids = list(self.filter(created__lt=before)
+                           .values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            deleted += self.filter(pk__in=ids).delete()[0]
+
+
+class AuditEvent(models.Model):
+    """
+    An append-only audit trail of account events. Events are buffered and
+    written in batches, see `api.audit`.
+    """
+    LOGIN = 'login'
+    LOGIN_FAILED = 'login_failed'
+    REGISTER = 'register'
+    VERIFY_EMAIL = 'verify_email'
+    CHANGE_PASSWORD = 'change_password'
+    UPDATE_PROFILE = 'update_profile'
+
+    EVENT_CHOICES = (
+        (LOGIN, 'Logged in'),
+        (LOGIN_FAILED, 'Failed to log in'),
+        (REGISTER, 'Registered'),
+        (VERIFY_EMAIL, 'Verified e-mail'),
+        (CHANGE_PASSWORD, 'Changed password'),
+        (UPDATE_PROFILE, 'Updated profile'),
+    )
+
+    # not a foreign key, so that events outlive the users and are written
+    # without checking them
+    user_id = models.IntegerField(null=True, blank=True)
+    event = models.CharField(max_length=20, choices=EVENT_CHOICES)
+    ip = models.GenericIPAddressField(null=True, blank=True)
+    data = models.TextField(default='{}')  # JSON encoded details
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = AuditEventQuerySet.as_manager()
+
+    class Meta:
+        index_together = [('user_id', 'created')]
+
+    def __str__(self):
+        return '%s %s user %s' % (self.created, self.event, self.user_id)
+
+
+class UserShard(models.Model):
+    """
+    The directory of the user shards, in the default database: allocates
+    the ids of the users and records the database each user is on. See
+    `api.sharding`.
+    """
+    # the id of the user
+    id = models.AutoField(primary_key=True)
+
+    # normalized, so that users can be found by e-mail at login
+    email = models.CharField(max_length=254, unique=True, null=True)
+    shard = models.CharField(max_length=100)
+
+    def __str__(self):
+        return 'user %s on %s' % (self.pk, self.shard)
+
+
+class UserActivity(models.Model):
+    """
+    When each user was last seen making an authenticated API call. Kept
+    out of the user table, and written in batches, see `api.activity`.
+    """
+    user_id = models.IntegerField(primary_key=True)
+    last_seen = models.DateTimeField()
+
+    def __str__(self):
+        return 'user %s last seen %s' % (self.user_id, self.last_seen)
@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+import threading
+
+from django.utils.crypto import constant_time_compare
+
+from oauth2_provider.oauth2_validators import OAuth2Validator
+
+from .cache import TOKEN_CACHE_TIMEOUT, get_or_compute, token_cache_key
+from .sharding import get_access_token
+
+
+_local = threading.local()
+
+# the secrets are left out of the cached tokens, validating a token does not
+# need them
+CACHE_DEFERRED_FIELDS = ('token', 'application__client_secret',
+                         'user__password')
+
+
+@contextmanager
+def authenticated_user(username, password, user):
+    """
+    Lets the validator reuse the user just authenticated with these
+    credentials in the current thread, instead of hashing the password a
+    second time when issuing a token for them.
+    """
+    _local.credentials = (username, password, user)
+    try:
+        yield
+    finally:
+        del _local.credentials
+
+
+class CachedOAuth2Validator(OAuth2Validator):
+    """
+    Validates bearer tokens against a cache of the access tokens, along
+    with their user and application, instead of querying them on every
+    authenticated request.
+
+    Cached tokens are dropped by the signals in `api.signals` whenever the
+    token or its user is saved, so revoked tokens and deactivated users are
+    rejected right away by every process sharing the cache. Tokens are not
+    cached when `API_TOKEN_CACHE_TIMEOUT` is 0, the default of the settings
+    unless the cache is shared: with a cache per process, the other
+    processes would accept them until their entry expires. Bulk updates
+    bypassing the signals must call `api.cache.invalidate_tokens`
+    themselves.
+
+    The cached tokens hold neither the token itself, nor the secret of the
+    application or the password hash of the user.
+    """
+
+    def load_access_token(self, token, defer=()):
+        return get_access_token(token, defer=defer)
+
+    def validate_bearer_token(self, token, scopes, request):
+        if not token:
+            return False
+
+        if TOKEN_CACHE_TIMEOUT:
+            access_token = get_or_compute(
+                token_cache_key(token),
+                lambda: self.load_access_token(token,
+                                               CACHE_DEFERRED_FIELDS),
+                TOKEN_CACHE_TIMEOUT)
+        else:
+            access_token = self.load_access_token(token)
+
+        if access_token is None or not access_token.is_valid(scopes):
+            return False
+
+        request.client = access_token.application
+        request.user = access_token.user
+        request.scopes = scopes
+
+        # this is needed by django rest framework
+        request.access_token = access_token
+        return True
+
+    def validate_user(self, username, password, client, request,
+                      *args, **kwargs):
+        credentials = getattr(_local, 'credentials', None)
+
+        if credentials is not None and credentials[0] == username and \
+                constant_time_compare(credentials[1], password):
+            user = credentials[2]
+            if user.is_active:
+                request.user = user
+                return True
+            return False
+
+        return super(CachedOAuth2Validator, self).validate_user(
+            username, password, client, request, *args, **kwargs)
@@ -10,3 +10,14 @@ class IsAuthenticatedAndActive(permissions.IsAuthenticated):
         _has_permission = super(IsAuthenticatedAndActive, self) \
                                  .has_permission(request, view)
         return _has_permission and request.user.is_active
+
+
+class IsActiveAdmin(IsAuthenticatedAndActive):
+    """
+    Allows access only to authenticated and active staff users.
+    """
+
+    def has_permission(self, request, view):
+        _has_permission = super(IsActiveAdmin, self) \
+                                 .has_permission(request, view)
+        return _has_permission and request.user.is_staff
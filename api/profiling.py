@@ -0,0 +1,279 @@
+"""
+Statistical profiling of the views in `api.views`.
+
+Profiling is enabled per view with a sampling rate, through the
+`profile_views` management command or `/api/profiling/`, or for a single
+request with an `X-Profile` header holding a token signed with the
+`SECRET_KEY` (see `make_token`). While a request is profiled, a
+background thread samples its stack every `API_PROFILING_INTERVAL`
+seconds. Samples are aggregated per view as collapsed stacks in the cache,
+and exported as collapsed stacks (for flamegraph.pl) or speedscope files.
+
+When profiling is off, the only cost is a check of the configuration,
+which is read from the cache at most every `CONFIG_TTL` seconds.
+"""
+from collections import Counter
+import json
+import random
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.utils.deprecation import MiddlewareMixin
+
+
+INTERVAL = getattr(settings, 'API_PROFILING_INTERVAL', 0.005)
+MAX_STACKS = getattr(settings, 'API_PROFILING_MAX_STACKS', 5000)
+CONFIG_TTL = 5
+
+PROFILED_MODULE = 'api.views'
+HEADER = 'HTTP_X_PROFILE'
+SIGNING_SALT = 'api.profiling'
+
+CONFIG_KEY = 'api:profiling:config'
+STACKS_KEY = 'api:profiling:stacks:%s'
+VIEWS_KEY = 'api:profiling:views'
+
+
+def get_view_name(view_func):
+    view = getattr(view_func, 'view_class', view_func)
+    return '%s.%s' % (view.__module__, view.__name__)
+
+
+def is_profilable(view_name):
+    return view_name.rsplit('.', 1)[0] == PROFILED_MODULE
+
+
+def enable(rates, duration):
+    """
+    Enables profiling of a fraction of the requests to the given views, as
+    a dict of view name to sampling rate, for `duration` seconds.
+    """
+    cache.set(CONFIG_KEY, {'rates': rates, 'until': time.time() + duration},
+              duration)
+
+
+def disable():
+    cache.delete(CONFIG_KEY)
+
+
+def get_config():
+    config = cache.get(CONFIG_KEY)
+    if config and config['until'] > time.time():
+        return config
+    return None
+
+
+def make_token(max_age=3600):
+    """
+    Returns a value for the `X-Profile` header, valid for `max_age` seconds.
+    """
+    return signing.dumps({'until': time.time() + max_age}, salt=SIGNING_SALT)
+
+
+def check_token(token):
+    try:
+        data = signing.loads(token, salt=SIGNING_SALT)
+    except signing.BadSignature:
+        return False
+    return data.get('until', 0) > time.time()
+
+
+def format_frame(frame):
+    return '%s:%s' % (frame.f_globals.get('__name__', '?'),
+                      frame.f_code.co_name)
+
+
+def collapse(frame):
+    """
+    Returns the stack of the frame, from the outermost call, as a string of
+    frames separated by semicolons.
+    """
+    frames = []
+    while frame is not None:
+        frames.append(format_frame(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+class Sampler(object):
+    """
+    Samples the stacks of the registered threads from a background thread,
+    which sleeps while no thread is registered.
+    """
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.thread = None
+
+    def start(self, thread_id):
+        with self.lock:
+            self.threads[thread_id] = Counter()
+            self.active.set()
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='api-profiler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self, thread_id):
+        with self.lock:
+            stacks = self.threads.pop(thread_id, Counter())
+            if not self.threads:
+                self.active.clear()
+        return stacks
+
+    def run(self):
+        while True:
+            self.active.wait()
+            frames = sys._current_frames()
+
+            with self.lock:
+                for thread_id, stacks in self.threads.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[collapse(frame)] += 1
+
+            del frames
+            time.sleep(self.interval)
+
+
+sampler = Sampler()
+
+
+def record(view_name, stacks):
+    """
+    Adds the samples of a request to the stacks of the view in the cache.
+    Concurrent updates may lose samples, which is fine for statistics.
+    """
+    if not stacks:
+        return
+
+    key = STACKS_KEY % view_name
+    aggregated = Counter(cache.get(key) or {})
+    aggregated.update(stacks)
+
+    if len(aggregated) > MAX_STACKS:
+        aggregated = Counter(dict(aggregated.most_common(MAX_STACKS)))
+
+    cache.set(key, dict(aggregated), None)
+
+    views = cache.get(VIEWS_KEY) or set()
+    if view_name not in views:
+        cache.set(VIEWS_KEY, views | set([view_name]), None)
+
+
+def get_stacks(view_name):
+    return cache.get(STACKS_KEY % view_name) or {}
+
+
+def get_profiled_views():
+    return sorted(cache.get(VIEWS_KEY) or [])
+
+
+def clear():
+    cache.delete_many([STACKS_KEY % view_name
+                       for view_name in get_profiled_views()] + [VIEWS_KEY])
+
+
+def to_collapsed(stacks, name=None):
+    return ''.join('%s %s\n' % (stack, count)
+                   for stack, count in sorted(stacks.items()))
+
+
+def to_speedscope(stacks, name, interval=INTERVAL):
+    frames = []
+    frame_indexes = {}
+    samples = []
+    weights = []
+
+    for stack, count in sorted(stacks.items()):
+        sample = []
+        for frame in stack.split(';'):
+            if frame not in frame_indexes:
+                module, function = frame.rsplit(':', 1)
+                frame_indexes[frame] = len(frames)
+                frames.append({'name': function, 'file': module})
+            sample.append(frame_indexes[frame])
+        samples.append(sample)
+        weights.append(count * interval * 1000)
+
+    return json.dumps({
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'dubai',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights,
+        }],
+    })
+
+
+EXPORTERS = {
+    'collapsed': (to_collapsed, 'text/plain'),
+    'speedscope': (to_speedscope, 'application/json'),
+}
+
+
+def export(view_name, output_format):
+    exporter, content_type = EXPORTERS[output_format]
+    return exporter(get_stacks(view_name), view_name)
+
+
+class SamplingProfilerMiddleware(MiddlewareMixin):
+    """
+    Profiles the requests selected by the configuration or by a signed
+    `X-Profile` header.
+    """
+    _config = None
+    _config_expires = 0
+
+    def get_config(self):
+        now = time.time()
+        if now > self._config_expires:
+            SamplingProfilerMiddleware._config = get_config()
+            SamplingProfilerMiddleware._config_expires = now + CONFIG_TTL
+        return self._config
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if HEADER in request.META:
+            if not check_token(request.META[HEADER]):
+                return None
+            rates = None
+        else:
+            config = self.get_config()
+            if config is None:
+                return None
+            rates = config['rates']
+
+        view_name = get_view_name(view_func)
+        if not is_profilable(view_name):
+            return None
+
+        # requests with a valid header are always profiled
+        rate = 1 if rates is None else rates.get(view_name, 0)
+
+        if rate > 0 and random.random() < rate:
+            request._profiled_view = view_name
+            sampler.start(threading.get_ident())
+
+    def process_response(self, request, response):
+        view_name = getattr(request, '_profiled_view', None)
+
+        if view_name is not None:
+            record(view_name, sampler.stop(threading.get_ident()))
+
+        return response
@@ -1,16 +1,26 @@
+import json
+
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from django.utils.translation import ugettext as _
 
 from rest_framework import serializers
-from rest_framework.validators import UniqueValidator
+
+from . import sharding
+from .batch import get_max_size
+from .models import AuditEvent
+from .profiling import PROFILED_MODULE, is_profilable
+from .validators import UniqueEmailValidator
+
+
+EMAIL_TAKEN_MESSAGE = _('E-mail address is already taken!')
 
 
 class AccountSerializer(serializers.ModelSerializer):
     email = serializers.EmailField(
         required=True,
-        validators=[UniqueValidator(queryset=User.objects.all(),
-                                    message=_('E-mail address is already '
-                                              'taken!'))]
+        validators=[UniqueEmailValidator(queryset=User.objects.all(),
+                                         message=EMAIL_TAKEN_MESSAGE)]
     )
     first_name = serializers.CharField(required=False)
     last_name = serializers.CharField(required=False)
@@ -18,7 +28,7 @@ class AccountSerializer(serializers.ModelSerializer):
                                      style={'input_type': 'password'})
 
     def create(self, validated_data):
-        user = User.objects.create(
+        user = User(
             email=validated_data['email'],
             username=validated_data['email'],
             first_name=validated_data.get('first_name', ''),
@@ -27,10 +37,41 @@ class AccountSerializer(serializers.ModelSerializer):
         )
 
         user.set_password(validated_data['password'])
-        user.save()
+
+        # the id and the shard of the user come from the shard directory
+        shard = None
+        if sharding.is_enabled():
+            try:
+                user.pk, shard = sharding.allocate(user.email)
+            except IntegrityError:
+                raise serializers.ValidationError(
+                    {'email': [EMAIL_TAKEN_MESSAGE]})
+
+        # the e-mail index catches registrations racing past the validator
+        try:
+            with transaction.atomic(using=shard):
+                user.save(using=shard)
+        except IntegrityError:
+            if shard is not None:
+                sharding.release(user.pk)
+            raise serializers.ValidationError({'email': [EMAIL_TAKEN_MESSAGE]})
 
         return user
 
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+
+        # only the given fields are saved, as the instance may be a copy
+        # from the token cache with a stale last login (see api.activity)
+        try:
+            with transaction.atomic(using=instance._state.db):
+                instance.save(update_fields=list(validated_data))
+        except IntegrityError:
+            raise serializers.ValidationError({'email': [EMAIL_TAKEN_MESSAGE]})
+
+        return instance
+
     class Meta:
         model = User
         fields = ('email', 'first_name', 'last_name', 'password')
@@ -68,3 +109,59 @@ class ChangePasswordSerializer(serializers.Serializer):
             raise serializers.ValidationError(
                 'New password must be different from old password')
         return data
+
+
+class SubRequestSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(
+        choices=('GET', 'POST', 'PUT', 'PATCH', 'DELETE'), default='GET')
+    path = serializers.CharField()
+    body = serializers.JSONField(required=False)
+
+
+class BatchSerializer(serializers.Serializer):
+    requests = SubRequestSerializer(many=True)
+
+    def validate_requests(self, value):
+        if not value:
+            raise serializers.ValidationError('No requests given.')
+
+        max_size = get_max_size()
+        if len(value) > max_size:
+            raise serializers.ValidationError(
+                'At most %s requests are allowed per batch.' % max_size)
+        return value
+
+
+class ProfilingSerializer(serializers.Serializer):
+    views = serializers.ListField(child=serializers.CharField())
+    rate = serializers.FloatField(min_value=0, max_value=1)
+    duration = serializers.IntegerField(min_value=1, max_value=86400,
+                                        default=600)
+
+    def validate_views(self, value):
+        for view_name in value:
+            if not is_profilable(view_name):
+                raise serializers.ValidationError(
+                    '%s is not a view of %s' % (view_name, PROFILED_MODULE))
+        return value
+
+
+class AuditEventSerializer(serializers.ModelSerializer):
+    data = serializers.SerializerMethodField()
+
+    class Meta:
+        model = AuditEvent
+        fields = ('id', 'user_id', 'event', 'ip', 'data', 'created')
+
+    def get_data(self, obj):
+        return json.loads(obj.data)
+
+
+class AuditQuerySerializer(serializers.Serializer):
+    user = serializers.IntegerField(required=False)
+    event = serializers.ChoiceField(choices=AuditEvent.EVENT_CHOICES,
+                                    required=False)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000,
+                                     default=100)
@@ -0,0 +1,405 @@
+"""
+Sharding of the users, with their OAuth2 tokens and e-mail addresses,
+across the databases listed in `API_USER_SHARDS`. Sharding is off when
+the list is empty.
+
+The ids of the users are allocated by the `UserShard` directory in the
+default database, which also records the database each user is on, so
+that users are found by id or by e-mail. New users are placed by a jump
+consistent hash of their id: adding a shard only moves the users that
+belong on the new shard, which the `rebalance_users` command does. The
+default database keeps the users created outside of registration (e.g.
+with `createsuperuser`) until they are rebalanced, and staff users for
+good, since the admin only sees the default database.
+
+Queries that do not start from a user or a token, like logging in or a
+background job given a user id, must pick the database with `use_shard`
+or `use_user_shard`. Lists of users are merged across databases by id
+with `iter_users`.
+
+Not covered: the admin, `export_users` and `import_users` only see the
+default database, groups and permissions of moved users are not moved,
+and writes to a user while `rebalance_users` moves it may be lost.
+"""
+from contextlib import contextmanager
+import heapq
+from operator import attrgetter
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from allauth.account.models import EmailAddress, EmailConfirmation
+
+from oauth2_provider.models import AccessToken, Application, RefreshToken
+
+from . import validators
+from .models import UserChange, UserShard
+
+
+SHARDED_MODELS = ('auth.user', 'oauth2_provider.accesstoken',
+                  'oauth2_provider.refreshtoken', 'oauth2_provider.grant',
+                  'account.emailaddress', 'account.emailconfirmation')
+
+# copied to every shard, since the sharded models refer to them
+REPLICATED_MODELS = ('oauth2_provider.application', )
+
+# the apps whose tables are created on the shards: the ones of the sharded
+# and replicated models, and the ones they refer to
+SHARD_APPS = ('auth', 'contenttypes', 'account', 'oauth2_provider')
+
+_local = threading.local()
+
+
+def get_shards():
+    return list(getattr(settings, 'API_USER_SHARDS', []))
+
+
+def is_enabled():
+    return bool(get_shards())
+
+
+def get_databases():
+    """
+    Returns the databases users may be on.
+    """
+    return [DEFAULT_DB_ALIAS] + [alias for alias in get_shards()
+                                 if alias != DEFAULT_DB_ALIAS]
+
+
+def jump_hash(key, buckets):
+    """
+    Returns the bucket of the key, in `range(buckets)`, with the jump
+    consistent hash of Lamping and Veach. When a bucket is added, keys
+    only move to the new bucket.
+    """
+    key &= 0xffffffffffffffff
+    bucket, jump = -1, 0
+
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+
+    return bucket
+
+
+def get_shard_for(user_id, shards=None):
+    """
+    Returns the shard the user belongs on.
+    """
+    if shards is None:
+        shards = get_shards()
+    return shards[jump_hash(user_id, len(shards))]
+
+
+def get_pinned_shard():
+    return getattr(_local, 'shard', None)
+
+
+@contextmanager
+def use_shard(alias):
+    """
+    Sends the queries of sharded models that do not start from an instance
+    to the given database, in the current thread.
+    """
+    previous = get_pinned_shard()
+    _local.shard = alias
+    try:
+        yield alias
+    finally:
+        _local.shard = previous
+
+
+def _directory_key(user_id):
+    return 'api:shard:%s' % user_id
+
+
+def lookup_shard(user_id):
+    """
+    Returns the database the user is on, or None for an unknown user.
+    """
+    key = _directory_key(user_id)
+    shard = cache.get(key)
+
+    if shard is None:
+        shard = UserShard.objects.filter(pk=user_id) \
+                                 .values_list('shard', flat=True).first()
+        if shard is not None:
+            cache.set(key, shard, None)
+
+    return shard
+
+
+def _directory_email(email):
+    # users without an e-mail share the NULL value
+    return validators.normalize_email(email) or None
+
+
+def lookup_shard_by_email(email):
+    return UserShard.objects.filter(email=_directory_email(email)) \
+                            .values_list('shard', flat=True).first()
+
+
+def forget_shards(user_ids):
+    cache.delete_many([_directory_key(user_id) for user_id in user_ids])
+
+
+@contextmanager
+def use_user_shard(user_id=None, email=None):
+    """
+    Pins the database of the user given by id or e-mail. Does nothing when
+    sharding is off or the user is unknown.
+    """
+    shard = None
+
+    if is_enabled():
+        if user_id is not None:
+            shard = lookup_shard(user_id)
+        elif email:
+            shard = lookup_shard_by_email(email)
+
+    if shard is None:
+        yield None
+    else:
+        with use_shard(shard) as alias:
+            yield alias
+
+
+def allocate(email, shard=None):
+    """
+    Allocates the id of a new user and returns it with the database the
+    user must be saved to, by default the shard it belongs on. Raises
+    `IntegrityError` if the e-mail is taken.
+    """
+    with transaction.atomic():
+        entry = UserShard.objects.create(email=_directory_email(email),
+                                         shard=shard or '')
+        if shard is None:
+            entry.shard = get_shard_for(entry.pk)
+            entry.save(update_fields=['shard'])
+
+    return entry.pk, entry.shard
+
+
+def release(user_id, shard=None):
+    """
+    Removes the user from the directory, if it is still on `shard` when
+    given. Also used when a user could not be saved after `allocate`.
+    """
+    queryset = UserShard.objects.filter(pk=user_id)
+    if shard is not None:
+        queryset = queryset.filter(shard=shard)
+    queryset.delete()
+    forget_shards([user_id])
+
+
+def update_email(user_id, email):
+    """
+    Records the new e-mail of the user. Raises `IntegrityError` if it is
+    taken, without breaking the transaction of the caller.
+    """
+    with transaction.atomic():
+        UserShard.objects.filter(pk=user_id) \
+                         .exclude(email=_directory_email(email)) \
+                         .update(email=_directory_email(email))
+
+
+def get_access_token(token, defer=()):
+    """
+    Returns the access token, with its application and user, looking for
+    it on each database in turn. Returns None if there is no such token.
+    The `defer` fields are only loaded if they are used.
+    """
+    queryset = AccessToken.objects.select_related('application', 'user') \
+                                  .defer(*defer)
+
+    if not is_enabled():
+        return queryset.filter(token=token).first()
+
+    for alias in get_databases():
+        access_token = queryset.using(alias).filter(token=token).first()
+        if access_token is not None:
+            return access_token
+
+    return None
+
+
+def iter_by_pk(queryset, batch_size=1000):
+    """
+    Iterates over the queryset in primary key order, with one keyset query
+    per batch.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+
+    while True:
+        batch = queryset
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+
+        for obj in batch:
+            yield obj
+
+        if len(batch) < batch_size:
+            return
+        last_pk = batch[-1].pk
+
+
+def merge_by_pk(iterables):
+    """
+    Merges iterables of objects sorted by primary key. An object found in
+    several of them, like a user being moved, is only returned once.
+    """
+    last_pk = None
+
+    for obj in heapq.merge(*iterables, key=attrgetter('pk')):
+        if obj.pk != last_pk:
+            yield obj
+            last_pk = obj.pk
+
+
+def iter_users(queryset, batch_size=1000):
+    """
+    Iterates over the users of the queryset on all the databases in id
+    order, reading each database in batches as the merge needs them.
+    """
+    if not is_enabled():
+        return iter_by_pk(queryset, batch_size)
+
+    return merge_by_pk([iter_by_pk(queryset.using(alias), batch_size)
+                        for alias in get_databases()])
+
+
+def replicate_application(application, deleted=False):
+    """
+    Copies the application to every shard, without its owner who may not
+    be on that shard.
+    """
+    values = dict((field.attname, getattr(application, field.attname))
+                  for field in application._meta.concrete_fields
+                  if field.attname not in ('id', 'user_id'))
+
+    for alias in get_shards():
+        if alias == DEFAULT_DB_ALIAS:
+            continue
+
+        queryset = Application.objects.using(alias).filter(pk=application.pk)
+        if deleted:
+            queryset.delete()
+        elif not queryset.update(**values):
+            Application.objects.using(alias).create(pk=application.pk,
+                                                    **values)
+
+
+def _copy(obj, using, **values):
+    # saved with a new primary key, ids are only unique per database, and
+    # with the ids of the copies it refers to
+    for name, value in values.items():
+        setattr(obj, name, value)
+    obj.pk = None
+    obj.save(using=using, force_insert=True)
+    return obj
+
+
+def move_user(user_id, source, target):
+    """
+    Moves the user, with its e-mail addresses and tokens, from the source
+    database to the target one. Returns False if the user was not found
+    on the source database, or is staff and kept on the default one.
+    """
+    user = User.objects.using(source).filter(pk=user_id).first()
+    if user is None or (user.is_staff and source == DEFAULT_DB_ALIAS):
+        return False
+
+    with transaction.atomic(using=target):
+        # leftovers of an interrupted move, the directory still points to
+        # the source
+        User.objects.using(target).filter(pk=user_id).delete()
+
+        User.objects.using(target).bulk_create([user])
+
+        for email_address in EmailAddress.objects.using(source) \
+                                                 .filter(user_id=user_id):
+            confirmations = list(EmailConfirmation.objects.using(source)
+                                 .filter(email_address=email_address))
+            email_address = _copy(email_address, target)
+            for confirmation in confirmations:
+                _copy(confirmation, target,
+                      email_address_id=email_address.pk)
+
+        refresh_tokens = dict(
+            (refresh_token.access_token_id, refresh_token)
+            for refresh_token in RefreshToken.objects.using(source)
+                                                     .filter(user_id=user_id))
+
+        for access_token in AccessToken.objects.using(source) \
+                                               .filter(user_id=user_id):
+            refresh_token = refresh_tokens.pop(access_token.pk, None)
+            access_token = _copy(access_token, target)
+            if refresh_token is not None:
+                _copy(refresh_token, target, access_token_id=access_token.pk)
+
+        # grants only live for a few minutes and are not moved
+
+    UserShard.objects.filter(pk=user_id).update(shard=target)
+    forget_shards([user_id])
+
+    # deleting the user from the source records it as deleted, but it was
+    # only moved
+    User.objects.using(source).filter(pk=user_id).delete()
+    UserChange.objects.record([user_id], UserChange.UPSERT)
+
+    return True
+
+
+class UserShardRouter(object):
+    """
+    Routes the sharded models to the database of the instance they are
+    read or written with, or of its user, or to the pinned database (see
+    `use_shard`). Does nothing when sharding is off.
+    """
+
+    def db_for_model(self, model, **hints):
+        if not is_enabled() or model._meta.label_lower not in SHARDED_MODELS:
+            return None
+
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db and \
+                instance._meta.label_lower in SHARDED_MODELS:
+            return instance._state.db
+
+        pinned = get_pinned_shard()
+        if pinned is not None:
+            return pinned
+
+        if instance is not None:
+            if isinstance(instance, User):
+                user_id = instance.pk
+            else:
+                user_id = getattr(instance, 'user_id', None)
+
+            if user_id is not None:
+                return lookup_shard(user_id)
+
+        return None
+
+    db_for_read = db_for_model
+    db_for_write = db_for_model
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_enabled() and (obj1._meta.label_lower in REPLICATED_MODELS or
+                             obj2._meta.label_lower in REPLICATED_MODELS):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the jobs, the change log, the audit trail and the directory stay
+        # on the default database
+        if not is_enabled() or db == DEFAULT_DB_ALIAS or \
+                db not in get_shards():
+            return None
+        return app_label in SHARD_APPS
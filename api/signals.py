@@ -0,0 +1,109 @@
+from django.contrib.auth.models import User, update_last_login
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from oauth2_provider.models import AccessToken, Application
+
+from . import activity, sharding, sync
+from .cache import (invalidate_profile, invalidate_tokens,
+                    invalidate_user_list)
+from .models import UserChange
+
+
+# last logins are written in batches instead, see api.activity. Connected
+# by django.contrib.auth without a dispatch_uid.
+user_logged_in.disconnect(update_last_login)
+
+
+@receiver(user_logged_in, dispatch_uid='api_record_login')
+def record_login(sender, user, **kwargs):
+    activity.record_login(user.pk)
+
+
+@receiver(post_save, sender=User, dispatch_uid='api_record_user_saved')
+def record_user_saved(sender, instance, created=False, raw=False,
+                      update_fields=None, **kwargs):
+    if raw:
+        return
+
+    if created or update_fields is None or \
+            sync.SYNCED_FIELDS.intersection(update_fields):
+        UserChange.objects.record([instance.pk], UserChange.UPSERT)
+
+
+@receiver(post_delete, sender=User, dispatch_uid='api_record_user_deleted')
+def record_user_deleted(sender, instance, **kwargs):
+    UserChange.objects.record([instance.pk], UserChange.DELETE)
+
+
+@receiver(post_save, sender=User, dispatch_uid='api_invalidate_user_saved')
+@receiver(post_delete, sender=User,
+          dispatch_uid='api_invalidate_user_deleted')
+def invalidate_user(sender, instance, using=None, **kwargs):
+    invalidate_user_list()
+    invalidate_profile(instance.pk)
+
+    # cached tokens hold a copy of their user
+    invalidate_tokens(AccessToken.objects.using(using)
+                                         .filter(user_id=instance.pk)
+                                         .values_list('token', flat=True))
+
+
+@receiver(post_save, sender=AccessToken,
+          dispatch_uid='api_invalidate_token_saved')
+@receiver(post_delete, sender=AccessToken,
+          dispatch_uid='api_invalidate_token_deleted')
+def invalidate_token(sender, instance, **kwargs):
+    invalidate_tokens([instance.token])
+
+
+@receiver(pre_save, sender=AccessToken,
+          dispatch_uid='api_invalidate_token_replaced')
+def invalidate_replaced_token(sender, instance, using=None, **kwargs):
+    # refreshing may reuse the row of an access token with a new token
+    if instance.pk is not None:
+        invalidate_tokens(AccessToken.objects.using(using)
+                                             .filter(pk=instance.pk)
+                                             .exclude(token=instance.token)
+                                             .values_list('token', flat=True))
+
+
+@receiver(pre_save, sender=User, dispatch_uid='api_allocate_user_id')
+def allocate_user_id(sender, instance, raw=False, using=None, **kwargs):
+    # users created outside of registration, e.g. with createsuperuser,
+    # also get their id from the shard directory
+    if sharding.is_enabled() and instance.pk is None and not raw:
+        instance.pk = sharding.allocate(instance.email, shard=using)[0]
+
+
+@receiver(pre_save, sender=User, dispatch_uid='api_update_user_shard')
+def update_user_shard(sender, instance, raw=False, update_fields=None,
+                      **kwargs):
+    # the new e-mail is claimed before the user is written, so that a taken
+    # e-mail fails the save instead of leaving the directory behind. If the
+    # write fails after all, the e-mail stays claimed until the next save.
+    if sharding.is_enabled() and not instance._state.adding and not raw and \
+            (update_fields is None or 'email' in update_fields):
+        sharding.update_email(instance.pk, instance.email)
+
+
+@receiver(post_delete, sender=User, dispatch_uid='api_release_user_shard')
+def release_user_shard(sender, instance, using=None, **kwargs):
+    # users moved by rebalance_users are deleted from their previous shard
+    if sharding.is_enabled():
+        sharding.release(instance.pk, shard=using)
+
+
+@receiver(post_save, sender=Application,
+          dispatch_uid='api_replicate_application_saved')
+def replicate_application_saved(sender, instance, raw=False, **kwargs):
+    if sharding.is_enabled() and not raw:
+        sharding.replicate_application(instance)
+
+
+@receiver(post_delete, sender=Application,
+          dispatch_uid='api_replicate_application_deleted')
+def replicate_application_deleted(sender, instance, **kwargs):
+    if sharding.is_enabled():
+        sharding.replicate_application(instance, deleted=True)
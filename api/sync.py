@@ -0,0 +1,57 @@
+"""
+Incremental sync of the user list, based on the `UserChange` log.
+
+Changes are numbered when they are written, not when their transaction
+commits. A transaction writing users that commits more than
+`API_SYNC_SETTLE_SECONDS` after its first change (e.g. a slow batch of
+`import_users`) may commit changes numbered below the `next` a client was
+already given, and that client misses them until it syncs from 0 again.
+Keep the setting above the longest transaction writing users.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import UserChange
+
+
+# the fields of the users served by the sync, see AccountSerializer: saves
+# that only change other fields (e.g. the password) are not recorded
+SYNCED_FIELDS = frozenset(['email', 'first_name', 'last_name'])
+
+
+def get_settle_delay():
+    # changes are only served once they are this old, so that a change
+    # whose transaction commits after a later one is not skipped
+    return getattr(settings, 'API_SYNC_SETTLE_SECONDS', 1)
+
+
+def get_changes(since, limit):
+    """
+    Returns the users upserted and deleted after the change `since`, as
+    a tuple of `(upserted ids, deleted ids, last seq, has more)`. Only the
+    latest change of each user counts.
+    """
+    threshold = timezone.now() - timedelta(seconds=get_settle_delay())
+
+    changes = list(UserChange.objects.filter(seq__gt=since,
+                                             created__lte=threshold)
+                                     .order_by('seq')
+                                     .values_list('seq', 'user_id', 'kind')
+                                     [:limit + 1])
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    latest = {}
+    for seq, user_id, kind in changes:
+        latest[user_id] = kind
+
+    upserted = [user_id for user_id, kind in latest.items()
+                if kind == UserChange.UPSERT]
+    deleted = [user_id for user_id, kind in latest.items()
+               if kind == UserChange.DELETE]
+    last_seq = changes[-1][0] if changes else since
+
+    return upserted, deleted, last_seq, has_more
@@ -0,0 +1,75 @@
+from allauth.account import signals
+from allauth.account.adapter import get_adapter
+from allauth.account.models import EmailAddress, EmailConfirmation
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from oauth2_provider.models import AccessToken
+
+from . import jobs, sharding
+from .jobs import job
+from .sharding import use_user_shard
+
+
+@job()
+def send_email_confirmation(user_id, signup=False):
+    """
+    Sends the verification e-mail to the user through django-allauth.
+    Runs outside of a request, so allauth builds the activation link from
+    the current `Site`.
+    """
+    with use_user_shard(user_id=user_id):
+        user = User.objects.get(pk=user_id)
+
+        try:
+            email_address = EmailAddress.objects.get_for_user(user,
+                                                              user.email)
+        except EmailAddress.DoesNotExist:
+            EmailAddress.objects.add_email(None, user, user.email,
+                                           signup=signup, confirm=True)
+        else:
+            if not email_address.verified:
+                email_address.send_confirmation(None, signup=signup)
+
+
+@job()
+def confirm_email_address(email_address_id, user_id=None):
+    """
+    Marks the e-mail address as verified, the same way django-allauth does
+    when a confirmation is confirmed. The user id tells the shard of the
+    e-mail address when the users are sharded.
+    """
+    with use_user_shard(user_id=user_id):
+        email_address = EmailAddress.objects.get(pk=email_address_id)
+
+        if not email_address.verified:
+            get_adapter(None).confirm_email(None, email_address)
+            signals.email_confirmed.send(sender=EmailConfirmation,
+                                         request=None,
+                                         email_address=email_address)
+
+
+@job(every=3600)
+def clear_expired_tokens(user_id=None):
+    """
+    Deletes the expired access tokens, of the given user only if any, on
+    every database. Tokens that still have a refresh token are kept so
+    that they can be refreshed.
+    """
+    tokens = AccessToken.objects.filter(refresh_token__isnull=True,
+                                        expires__lt=timezone.now())
+    if user_id is not None:
+        tokens = tokens.filter(user_id=user_id)
+
+    databases = sharding.get_databases() if sharding.is_enabled() else [None]
+    for alias in databases:
+        tokens.using(alias).delete()
+
+
+@job(every=24 * 3600)
+def purge_jobs():
+    """
+    Deletes the jobs finished more than `API_JOBS_RETENTION_DAYS` ago.
+    """
+    jobs.purge()
@@ -1,8 +1,25 @@
+from collections import Counter
 from datetime import timedelta
+from importlib import import_module
+from io import StringIO
+import json
+import os
 import re
+import shutil
+import tempfile
+from unittest import mock, skipUnless
 
+from django.apps import apps
+from django.contrib.auth.hashers import (check_password, get_hasher,
+                                         make_password)
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import (DEFAULT_DB_ALIAS, IntegrityError, connection,
+                       connections)
+from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 
@@ -12,9 +29,30 @@ from oauth2_provider.models import AccessToken, get_application_model
 from rest_framework import status
 from rest_framework.test import APITestCase
 
+from . import (activity, audit, cache as api_cache, limiter, profiling,
+               sharding)
+from .admin import UserAdmin
+from .jobs import (enqueue, job, purge as purge_jobs, requeue_stale,
+                   run_pending, schedule_periodic)
+from .models import AuditEvent, Job, UserActivity, UserChange
+from .validators import annotate_email
+
 
 Application = get_application_model()
 
+# the tests run on unsharded users whatever USER_SHARD_URLS says, except
+# ShardedUsersTest which sets up its own shards
+unsharded = override_settings(API_USER_SHARDS=[],
+                              ACCOUNT_EMAIL_CONFIRMATION_HMAC=True)
+
+
+def setUpModule():
+    unsharded.enable()
+
+
+def tearDownModule():
+    unsharded.disable()
+
 
 def get_verification_key(mail):
     match = re.search('/accounts/confirm-email/(.+)/$',
@@ -78,6 +116,55 @@ class RegisterUserTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_register_user_with_taken_email(self):
+        data = {
+            'email': self.email,
+            'password': self.password,
+        }
+
+        response = self.client.post(reverse('api_register'), data)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # e-mails are compared case-insensitively
+        data = {
+            'email': self.email.upper(),
+            'password': self.password,
+        }
+
+        response = self.client.post(reverse('api_register'), data)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('email', response.data)
+        self.assertEqual(User.objects.count(), 1)
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite query plan')
+    def test_email_lookup_uses_index(self):
+        queryset = annotate_email(User.objects.all()) \
+            .filter(email_lower=self.email).values('pk')
+        sql, params = queryset.query.sql_with_params()
+
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+        self.assertIn('api_user_email_lower_uniq', plan)
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite expression index')
+    def test_email_index_reports_duplicates(self):
+        migration = import_module('api.migrations.0001_user_email_lower_index')
+
+        with connection.schema_editor() as schema_editor:
+            migration.drop_email_index(apps, schema_editor)
+            User.objects.create_user(username='a', email=self.email)
+            User.objects.create_user(username='b', email=self.email.upper())
+
+            with self.assertRaisesRegex(CommandError, self.email):
+                migration.create_email_index(apps, schema_editor)
+
+            User.objects.filter(username='b').update(email='')
+            migration.create_email_index(apps, schema_editor)
+
 
 class VerifyEmailTest(APITestCase):
     def setUp(self):
@@ -98,6 +185,10 @@ class VerifyEmailTest(APITestCase):
         response = self.client.post(reverse('api_register'), data)
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # the e-mail is sent by a background job
+        self.assertEqual(len(mail.outbox), 0)
+        run_pending()
         self.assertEqual(len(mail.outbox), 1)
 
         # get the key from the email
@@ -162,6 +253,9 @@ class LoginTest(APITestCase):
 
         self.assertEqual(access_token.user.username, self.email)
 
+        # expired tokens are cleared periodically, not by each login
+        self.assertFalse(Job.objects.exists())
+
     def test_login_with_invalid_credentials(self):
         data = {
             'username': self.email,
@@ -336,6 +430,9 @@ class UserListTest(APITestCase):
 
 class UserProfileTest(APITestCase):
     def setUp(self):
+        # serialized profiles are cached across tests
+        cache.clear()
+
         self.email = 'potus@whitehouse.gov'
         self.password = 'donaldtrump'
         self.first_name = 'Donald'
@@ -393,6 +490,35 @@ class UserProfileTest(APITestCase):
 
         self.assertEqual(response.data, data)
 
+    def test_view_profile_after_update(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % self.access_token)  # noqa
+
+        # the first read caches the profile
+        response = self.client.get(reverse('api_profile'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['first_name'], self.first_name)
+
+        response = self.client.patch(reverse('api_profile'),
+                                     {'first_name': 'Hillary'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # the update invalidates the cached profile
+        response = self.client.get(reverse('api_profile'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['first_name'], 'Hillary')
+
+        # and so do saves outside of the API, e.g. in the admin
+        self.user.last_name = 'Clinton'
+        self.user.save()
+
+        response = self.client.get(reverse('api_profile'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['last_name'], 'Clinton')
+
     def test_view_profile_with_invalid_token(self):
         response = self.client.get(reverse('api_profile'))
 
@@ -446,6 +572,16 @@ class UserProfileTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+        # change email to an already existing email in a different case
+        data = {
+            'email': 'FLOTUS@whitehouse.gov',
+        }
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % self.access_token)  # noqa
+        response = self.client.patch(reverse('api_profile'), data)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
         # use invalid email
         data = {
             'email': 'thisisaninvalidemail',
@@ -455,3 +591,1281 @@ class UserProfileTest(APITestCase):
         response = self.client.patch(reverse('api_profile'), data)
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_get_or_compute(self):
+        compute = mock.Mock(return_value='donald')
+
+        self.assertEqual(api_cache.get_or_compute('potus', compute, 60),
+                         'donald')
+        self.assertEqual(api_cache.get_or_compute('potus', compute, 60),
+                         'donald')
+        self.assertEqual(compute.call_count, 1)
+
+    def test_get_or_compute_serves_stale_while_recomputing(self):
+        compute = mock.Mock(return_value='donald')
+
+        # an expired entry, being recomputed by another worker
+        cache.set('potus', ('barack', 0), 60)
+        cache.add('potus:lock', 1, 60)
+
+        self.assertEqual(api_cache.get_or_compute('potus', compute, 60),
+                         'barack')
+        self.assertFalse(compute.called)
+
+        # once the lock is released the entry is recomputed
+        cache.delete('potus:lock')
+
+        self.assertEqual(api_cache.get_or_compute('potus', compute, 60),
+                         'donald')
+        self.assertEqual(compute.call_count, 1)
+
+    def test_get_or_compute_waits_for_missing_entry(self):
+        compute = mock.Mock(return_value='donald')
+
+        cache.add('potus:lock', 1, 60)
+
+        # the other worker stores the entry while this one waits
+        def sleep(seconds):
+            cache.set('potus', ('barack', 0), 60)
+
+        with mock.patch('api.cache.time.sleep', side_effect=sleep):
+            self.assertEqual(api_cache.get_or_compute('potus', compute, 60),
+                             'barack')
+        self.assertFalse(compute.called)
+
+    @mock.patch('api.oauth2_validators.TOKEN_CACHE_TIMEOUT', 60)
+    def test_cached_token_of_deactivated_user(self):
+        user = User.objects.create_user(username='potus@whitehouse.gov',
+                                        email='potus@whitehouse.gov',
+                                        password='donaldtrump',
+                                        is_active=1)
+        app = Application.objects.create(
+            client_type=Application.CLIENT_PUBLIC,
+            authorization_grant_type=Application.GRANT_PASSWORD)
+        access_token = AccessToken.objects.create(
+            user=user, application=app, token=generate_token(),
+            expires=timezone.now() + timedelta(days=365))
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % access_token)  # noqa
+
+        # the token is cached along with its user
+        response = self.client.get(reverse('api_profile'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # without the secrets
+        cached = cache.get(api_cache.token_cache_key(access_token.token))[0]
+        self.assertEqual(cached.get_deferred_fields(), {'token'})
+        self.assertEqual(cached.application.get_deferred_fields(),
+                         {'client_secret'})
+        self.assertEqual(cached.user.get_deferred_fields(), {'password'})
+
+        user.is_active = 0
+        user.save()
+
+        response = self.client.get(reverse('api_profile'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # deleting the token drops it from the cache
+        access_token.delete()
+
+        response = self.client.get(reverse('api_profile'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_get_or_compute_locks_per_key(self):
+        # another thread is computing an unrelated key
+        api_cache._acquire_local_lock('flotus')
+        self.addCleanup(api_cache._release_local_lock, 'flotus')
+
+        self.assertEqual(api_cache.get_or_compute('potus', lambda: 'donald',
+                                                  60), 'donald')
+        self.assertNotIn('potus', api_cache._local_locks)
+
+
+class UserAdminTest(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin',
+                                                   email='admin@whitehouse.gov',
+                                                   password='donaldtrump')
+
+        for name in ('Barack', 'Michelle', 'Malia', 'Sasha'):
+            User.objects.create_user(username='%s@whitehouse.gov' % name,
+                                     email='%s@whitehouse.gov' % name,
+                                     password='obama',
+                                     first_name=name,
+                                     last_name='Obama',
+                                     is_active=1)
+
+        self.client.force_login(self.admin)
+
+    def get_emails(self, response):
+        return [user.email for user in response.context['cl'].result_list]
+
+    def test_search_users(self):
+        response = self.client.get(reverse('admin:auth_user_changelist'),
+                                   {'q': 'MA'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_emails(response),
+                         ['Malia@whitehouse.gov'])
+
+        # only prefixes match
+        response = self.client.get(reverse('admin:auth_user_changelist'),
+                                   {'q': 'ama'})
+
+        self.assertEqual(self.get_emails(response), [])
+
+    @mock.patch.object(UserAdmin, 'list_per_page', 2)
+    def test_keyset_pagination(self):
+        url = reverse('admin:auth_user_changelist')
+
+        response = self.client.get(url)
+
+        self.assertEqual(self.get_emails(response),
+                         ['Sasha@whitehouse.gov', 'Malia@whitehouse.gov'])
+
+        # the next page starts after the last user of the page
+        response = self.client.get(
+            url + response.context['cl'].next_cursor_query)
+
+        self.assertEqual(self.get_emails(response),
+                         ['Michelle@whitehouse.gov', 'Barack@whitehouse.gov'])
+
+    def test_bulk_actions(self):
+        url = reverse('admin:auth_user_changelist')
+        users = User.objects.filter(last_name='Obama')
+        selected = [str(pk) for pk in users.values_list('pk', flat=True)]
+
+        app = Application.objects.create(
+            client_type=Application.CLIENT_PUBLIC,
+            authorization_grant_type=Application.GRANT_PASSWORD)
+        access_token = AccessToken.objects.create(
+            user=users[0], application=app, token=generate_token(),
+            expires=timezone.now() + timedelta(days=365))
+
+        self.client.post(url, {'action': 'deactivate_users',
+                               '_selected_action': selected})
+
+        self.assertFalse(users.filter(is_active=True).exists())
+
+        self.client.post(url, {'action': 'revoke_tokens',
+                               '_selected_action': selected})
+
+        access_token.refresh_from_db()
+        self.assertTrue(access_token.is_expired())
+
+
+@override_settings(API_SYNC_SETTLE_SECONDS=0)
+class UserChangesTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='potus@whitehouse.gov',
+                                             email='potus@whitehouse.gov',
+                                             password='donaldtrump',
+                                             first_name='Donald',
+                                             is_active=1)
+
+    def get_changes(self, since, **params):
+        params['since'] = since
+        response = self.client.get(reverse('api_user_changes'), params)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_user_changes(self):
+        data = self.get_changes(0)
+
+        self.assertEqual(data['upserts'], [{'id': self.user.pk,
+                                            'first_name': 'Donald'}])
+        self.assertEqual(data['deletes'], [])
+        self.assertFalse(data['more'])
+
+        # nothing changed since
+        since = data['next']
+        data = self.get_changes(since)
+
+        self.assertEqual(data['upserts'], [])
+        self.assertEqual(data['next'], since)
+
+        # create a user and update it twice, delete another one
+        user = User.objects.create_user(username='flotus@whitehouse.gov',
+                                        email='flotus@whitehouse.gov',
+                                        password='melaniatrump')
+        user.first_name = 'Michelle'
+        user.save()
+        user.first_name = 'Melania'
+        user.save()
+
+        deleted_pk = self.user.pk
+        self.user.delete()
+
+        data = self.get_changes(since)
+
+        self.assertEqual(data['upserts'], [{'id': user.pk,
+                                            'first_name': 'Melania'}])
+        self.assertEqual(data['deletes'], [deleted_pk])
+
+    def test_user_changes_limit(self):
+        User.objects.create_user(username='flotus@whitehouse.gov',
+                                 email='flotus@whitehouse.gov',
+                                 password='melaniatrump')
+
+        data = self.get_changes(0, limit=1)
+
+        self.assertEqual(len(data['upserts']), 1)
+        self.assertTrue(data['more'])
+
+        data = self.get_changes(data['next'], limit=1)
+
+        self.assertEqual(len(data['upserts']), 1)
+        self.assertFalse(data['more'])
+
+    def test_ignore_unsynced_fields(self):
+        changes = UserChange.objects.count()
+
+        self.user.set_password('ilovemexicans')
+        self.user.save(update_fields=['password'])
+        self.assertEqual(UserChange.objects.count(), changes)
+
+        self.user.last_name = 'Trump'
+        self.user.save(update_fields=['last_name'])
+        self.assertEqual(UserChange.objects.count(), changes + 1)
+
+    def test_compact_user_changes(self):
+        for first_name in ('Hillary', 'Bill', 'Chelsea'):
+            self.user.first_name = first_name
+            self.user.save()
+
+        call_command('compact_user_changes', stdout=StringIO())
+
+        changes = UserChange.objects.filter(user_id=self.user.pk)
+
+        self.assertEqual(changes.count(), 1)
+        self.assertEqual(self.get_changes(0)['upserts'],
+                         [{'id': self.user.pk, 'first_name': 'Chelsea'}])
+
+
+class UserExportTest(APITestCase):
+    def setUp(self):
+        self.email = 'potus@whitehouse.gov'
+
+        self.admin = User.objects.create_user(username=self.email,
+                                              email=self.email,
+                                              password='donaldtrump',
+                                              first_name='Donald',
+                                              is_staff=True,
+                                              is_active=1)
+
+        self.user = User.objects.create_user(username='flotus@whitehouse.gov',
+                                             email='flotus@whitehouse.gov',
+                                             password='melaniatrump',
+                                             first_name='Melania',
+                                             is_active=1)
+
+        app_data = {
+            'client_type': Application.CLIENT_PUBLIC,
+            'authorization_grant_type': Application.GRANT_PASSWORD
+        }
+
+        self.app = Application.objects.create(**app_data)
+
+    def authenticate(self, user):
+        token_data = {
+            'user': user,
+            'application': self.app,
+            'expires': timezone.now() + timedelta(days=365),
+            'token': generate_token(),
+        }
+
+        access_token = AccessToken.objects.create(**token_data)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % access_token)  # noqa
+
+    def get_content(self, response):
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_export_users_as_csv(self):
+        self.authenticate(self.admin)
+        response = self.client.get(reverse('api_users_export'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        lines = self.get_content(response).splitlines()
+
+        self.assertEqual(lines[0], 'id,email,first_name,last_name')
+        self.assertEqual(lines[1], '%s,%s,Donald,' % (self.admin.pk,
+                                                      self.email))
+        self.assertEqual(len(lines), 3)
+
+    def test_export_users_as_ndjson_since(self):
+        self.authenticate(self.admin)
+        response = self.client.get(reverse('api_users_export'),
+                                   {'output': 'ndjson',
+                                    'since': self.admin.pk})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        rows = [json.loads(line)
+                for line in self.get_content(response).splitlines()]
+
+        self.assertEqual(rows, [{
+            'id': self.user.pk,
+            'email': 'flotus@whitehouse.gov',
+            'first_name': 'Melania',
+            'last_name': '',
+        }])
+
+    def test_export_users_with_invalid_format(self):
+        self.authenticate(self.admin)
+        response = self.client.get(reverse('api_users_export'),
+                                   {'output': 'xml'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_users_without_admin(self):
+        self.authenticate(self.user)
+        response = self.client.get(reverse('api_users_export'))
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_export_users_command(self):
+        output = StringIO()
+        call_command('export_users', '--format', 'ndjson', '--chunk-size', 1,
+                     stdout=output)
+
+        emails = [json.loads(line)['email']
+                  for line in output.getvalue().splitlines()]
+
+        self.assertEqual(emails, [self.email, 'flotus@whitehouse.gov'])
+
+
+class UserImportTest(APITestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        User.objects.create_user(username='potus@whitehouse.gov',
+                                 email='potus@whitehouse.gov',
+                                 password='donaldtrump')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_import_users_from_csv(self):
+        password_hash = make_password('melaniatrump')
+
+        path = self.write('users.csv', '\n'.join([
+            'email,first_name,last_name,password,password_hash,is_active',
+            'flotus@whitehouse.gov,Melania,Trump,,%s,1' % password_hash,
+            'vpotus@whitehouse.gov,Mike,Pence,mikepence,,0',
+            'thisisaninvalidemail,Hillary,Clinton,hillary,,1',
+            'POTUS@whitehouse.gov,Donald,Trump,donaldtrump,,1',
+            'Flotus@whitehouse.gov,Melania,Trump,melaniatrump,,1',
+            'nopassword@whitehouse.gov,Bernie,Sanders,,,1',
+        ]))
+        errors = os.path.join(self.directory, 'errors.ndjson')
+
+        call_command('import_users', path, '--errors', errors,
+                     stdout=StringIO())
+
+        self.assertEqual(User.objects.count(), 3)
+
+        user = User.objects.get(email='flotus@whitehouse.gov')
+        self.assertEqual(user.username, 'flotus@whitehouse.gov')
+        self.assertTrue(user.is_active)
+        self.assertTrue(user.check_password('melaniatrump'))
+
+        user = User.objects.get(email='vpotus@whitehouse.gov')
+        self.assertFalse(user.is_active)
+        self.assertTrue(user.check_password('mikepence'))
+
+        with open(errors) as f:
+            rejected = [json.loads(line) for line in f]
+
+        self.assertEqual([r['record'] for r in rejected], [3, 4, 5, 6])
+        self.assertIn('email', rejected[0]['errors'])
+        self.assertIn('email', rejected[1]['errors'])
+        self.assertIn('email', rejected[2]['errors'])
+        self.assertIn('password', rejected[3]['errors'])
+
+    def test_import_malformed_ndjson(self):
+        path = self.write('users.ndjson', '\n'.join([
+            '{"email": "flotus@whitehouse.gov"',
+            '["vpotus@whitehouse.gov"]',
+            json.dumps({'email': 'flotus@whitehouse.gov',
+                        'password': 'melaniatrump'}),
+        ]))
+        errors = os.path.join(self.directory, 'errors.ndjson')
+
+        call_command('import_users', path, '--errors', errors,
+                     stdout=StringIO())
+
+        # the malformed records are rejected, the others still imported
+        self.assertTrue(User.objects.filter(
+            email='flotus@whitehouse.gov').exists())
+
+        with open(errors) as f:
+            rejected = [json.loads(line) for line in f]
+
+        self.assertEqual([r['record'] for r in rejected], [1, 2])
+        self.assertIn('Invalid JSON',
+                      rejected[0]['errors']['non_field_errors'][0])
+        self.assertIn('Expected an object',
+                      rejected[1]['errors']['non_field_errors'][0])
+
+    def test_resume_import_from_checkpoint(self):
+        password_hash = make_password('donaldtrump')
+
+        path = self.write('users.ndjson', '\n'.join(
+            json.dumps({'email': 'user%s@whitehouse.gov' % i,
+                        'password_hash': password_hash})
+            for i in range(5)
+        ))
+        checkpoint = self.write('checkpoint.json', json.dumps(
+            {'position': 2, 'imported': 2, 'rejected': 0}))
+
+        call_command('import_users', path, '--checkpoint', checkpoint,
+                     '--batch-size', 2, stdout=StringIO())
+
+        # the first two records were already imported
+        self.assertFalse(User.objects.filter(
+            email__in=['user0@whitehouse.gov', 'user1@whitehouse.gov'])
+            .exists())
+        self.assertEqual(User.objects.count(), 4)
+
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f), {'position': 5, 'imported': 5,
+                                            'rejected': 0})
+
+
+# sub-requests run in the test thread, other threads cannot see the data of
+# the test transaction
+@override_settings(API_BATCH_MAX_WORKERS=1, API_BATCH_MAX_SIZE=5)
+class BatchTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.email = 'potus@whitehouse.gov'
+
+        self.user = User.objects.create_user(username=self.email,
+                                             email=self.email,
+                                             password='donaldtrump',
+                                             first_name='Donald',
+                                             last_name='Trump',
+                                             is_active=1)
+
+        app_data = {
+            'client_type': Application.CLIENT_PUBLIC,
+            'authorization_grant_type': Application.GRANT_PASSWORD
+        }
+
+        self.app = Application.objects.create(**app_data)
+
+        token_data = {
+            'user': self.user,
+            'application': self.app,
+            'expires': timezone.now() + timedelta(days=365),
+            'token': generate_token(),
+        }
+
+        self.access_token = AccessToken.objects.create(**token_data)
+
+    def post_batch(self, requests):
+        return self.client.post(reverse('api_batch'),
+                                {'requests': requests}, format='json')
+
+    def test_batch(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % self.access_token)  # noqa
+        response = self.post_batch([
+            {'path': '/api/profile/'},
+            {'path': '/api/users/'},
+            {'method': 'PATCH', 'path': '/api/profile/',
+             'body': {'first_name': 'Hillary'}},
+            {'path': '/api/profile/'},
+            {'path': '/api/nowhere/'},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['status'] for r in response.data],
+                         [200, 200, 200, 200, 404])
+
+        self.assertEqual(response.data[0]['body']['first_name'], 'Donald')
+        self.assertEqual(response.data[1]['body'][0]['email'], self.email)
+
+        # sub-requests run in order
+        self.assertEqual(response.data[3]['body']['first_name'], 'Hillary')
+
+    def test_batch_without_token(self):
+        response = self.post_batch([
+            {'path': '/api/users/'},
+            {'path': '/api/profile/'},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['status'] for r in response.data], [200, 401])
+
+        # sub-requests are made as the anonymous user
+        self.assertEqual(dict(response.data[0]['body'][0]),
+                         {'first_name': 'Donald'})
+
+    def test_batch_too_large(self):
+        response = self.post_batch([{'path': '/api/users/'}] * 6)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_excluded_views(self):
+        response = self.post_batch([
+            {'method': 'POST', 'path': '/api/batch/', 'body': {}},
+            {'method': 'POST', 'path': '/api/login/', 'body': {}},
+        ])
+
+        self.assertEqual([r['status'] for r in response.data], [404, 404])
+
+
+class ProfilingTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+        # forget the configuration memoized by the middleware
+        profiling.SamplingProfilerMiddleware._config_expires = 0
+
+        self.admin = User.objects.create_superuser(username='admin',
+                                                   email='admin@whitehouse.gov',
+                                                   password='donaldtrump')
+
+        patcher = mock.patch('api.profiling.sampler')
+        self.sampler = patcher.start()
+        self.sampler.stop.return_value = Counter({'api.views:get;re:search': 3})  # noqa
+        self.addCleanup(patcher.stop)
+
+    def test_profile_with_header(self):
+        self.client.get(reverse('api_users'),
+                        HTTP_X_PROFILE=profiling.make_token())
+
+        self.assertTrue(self.sampler.start.called)
+        self.assertEqual(profiling.get_profiled_views(),
+                         ['api.views.UserListView'])
+        self.assertEqual(profiling.get_stacks('api.views.UserListView'),
+                         {'api.views:get;re:search': 3})
+
+    def test_profile_with_invalid_header(self):
+        self.client.get(reverse('api_users'), HTTP_X_PROFILE='donaldtrump')
+
+        self.assertFalse(self.sampler.start.called)
+
+    def test_profile_when_enabled(self):
+        self.client.get(reverse('api_users'))
+
+        self.assertFalse(self.sampler.start.called)
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.post(reverse('api_profiling'), {
+            'views': ['api.views.UserListView'],
+            'rate': 1,
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        profiling.SamplingProfilerMiddleware._config_expires = 0
+        self.client.get(reverse('api_profile'))
+        self.client.get(reverse('api_users'))
+
+        # only the enabled view is profiled
+        self.assertEqual(self.sampler.start.call_count, 1)
+
+    def test_enable_profiling_of_other_module(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.post(reverse('api_profiling'), {
+            'views': ['django.contrib.admin.sites.AdminSite'],
+            'rate': 1,
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_stacks(self):
+        profiling.record('api.views.LoginView',
+                         Counter({'a:main;b:login': 2, 'a:main': 1}))
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse('api_profiling'),
+                                   {'view': 'api.views.LoginView'})
+
+        self.assertEqual(response.content.decode('utf-8'),
+                         'a:main 1\na:main;b:login 2\n')
+
+        response = self.client.get(reverse('api_profiling'),
+                                   {'view': 'api.views.LoginView',
+                                    'output': 'speedscope'})
+        data = json.loads(response.content.decode('utf-8'))
+
+        self.assertEqual(data['shared']['frames'],
+                         [{'name': 'main', 'file': 'a'},
+                          {'name': 'login', 'file': 'b'}])
+        self.assertEqual(data['profiles'][0]['samples'], [[0], [0, 1]])
+
+
+@job(max_attempts=2)
+def failing_job(message):
+    raise ValueError(message)
+
+
+@job()
+def succeeding_job():
+    pass
+
+
+class JobQueueTest(APITestCase):
+    def test_run_job(self):
+        instance = enqueue(succeeding_job)
+
+        self.assertEqual(run_pending(), 1)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, Job.DONE)
+        self.assertEqual(instance.attempts, 1)
+        self.assertIsNotNone(instance.duration)
+
+        # nothing is left to run
+        self.assertEqual(run_pending(), 0)
+
+    def test_retry_failed_job(self):
+        instance = enqueue(failing_job, message='obamacare')
+
+        self.assertEqual(run_pending(), 1)
+
+        # the job is queued again with a delay
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, Job.QUEUED)
+        self.assertIn('obamacare', instance.last_error)
+        self.assertGreater(instance.run_at, timezone.now())
+        self.assertEqual(run_pending(), 0)
+
+        # run the retry right away, it is the last attempt
+        Job.objects.filter(pk=instance.pk).update(run_at=timezone.now())
+
+        self.assertEqual(run_pending(), 1)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, Job.FAILED)
+        self.assertEqual(instance.attempts, 2)
+
+    def test_requeue_stale_jobs(self):
+        started = timezone.now() - timedelta(hours=1)
+        retried = enqueue(succeeding_job)
+        exhausted = enqueue(failing_job, message='obamacare')
+        Job.objects.filter(pk=retried.pk).update(
+            status=Job.RUNNING, started=started, attempts=1)
+        Job.objects.filter(pk=exhausted.pk).update(
+            status=Job.RUNNING, started=started, attempts=2)
+
+        self.assertEqual(requeue_stale(), 1)
+
+        retried.refresh_from_db()
+        exhausted.refresh_from_db()
+        self.assertEqual(retried.status, Job.QUEUED)
+        # a job crashing its worker is not retried forever
+        self.assertEqual(exhausted.status, Job.FAILED)
+
+    def test_schedule_periodic_jobs(self):
+        queued = schedule_periodic()
+
+        self.assertIn('api.tasks.clear_expired_tokens',
+                      [instance.name for instance in queued])
+        # queued once per period
+        self.assertEqual(schedule_periodic(), [])
+
+    def test_purge_finished_jobs(self):
+        old = enqueue(succeeding_job)
+        recent = enqueue(succeeding_job)
+        pending = enqueue(succeeding_job)
+        run_pending()
+
+        Job.objects.filter(pk=old.pk).update(
+            finished=timezone.now() - timedelta(days=30))
+        Job.objects.filter(pk=pending.pk).update(status=Job.QUEUED)
+
+        self.assertEqual(purge_jobs(days=7), 1)
+        self.assertEqual(set(Job.objects.values_list('pk', flat=True)),
+                         set([recent.pk, pending.pk]))
+
+
+class AuditTest(APITestCase):
+    def setUp(self):
+        # drop the events buffered by the other tests
+        audit.flush()
+        AuditEvent.objects.all().delete()
+
+        self.email = 'potus@whitehouse.gov'
+        self.password = 'donaldtrump'
+
+        self.user = User.objects.create_user(username=self.email,
+                                             email=self.email,
+                                             password=self.password,
+                                             is_active=1)
+        self.admin = User.objects.create_superuser(username='admin',
+                                                   email='admin@whitehouse.gov',
+                                                   password='donaldtrump')
+
+        self.app = Application.objects.create(
+            client_type=Application.CLIENT_PUBLIC,
+            authorization_grant_type=Application.GRANT_PASSWORD)
+
+    def login(self, password):
+        return self.client.post(reverse('api_login'), {
+            'username': self.email,
+            'password': password,
+            'grant_type': 'password',
+            'client_id': self.app.client_id,
+        })
+
+    def test_record_login(self):
+        self.login(self.password)
+        self.login('hillaryclinton')
+
+        # events are buffered until flushed
+        self.assertFalse(AuditEvent.objects.exists())
+        self.assertEqual(audit.flush(), 2)
+
+        events = list(AuditEvent.objects.between())
+        self.assertEqual([event.event for event in events],
+                         [AuditEvent.LOGIN_FAILED, AuditEvent.LOGIN])
+        self.assertEqual(events[1].user_id, self.user.pk)
+        self.assertEqual(events[1].ip, '127.0.0.1')
+        self.assertEqual(json.loads(events[0].data),
+                         {'username': self.email})
+
+    def test_flush_on_batch_size(self):
+        with mock.patch.object(audit.writer, 'batch_size', 2):
+            audit.record(AuditEvent.LOGIN, user_id=self.user.pk)
+            self.assertEqual(AuditEvent.objects.count(), 0)
+
+            audit.record(AuditEvent.LOGIN, user_id=self.user.pk)
+            self.assertEqual(AuditEvent.objects.count(), 2)
+
+    def test_list_events(self):
+        audit.record(AuditEvent.LOGIN, user_id=self.user.pk)
+        audit.record(AuditEvent.UPDATE_PROFILE, user_id=self.user.pk,
+                     fields=['first_name'])
+        audit.record(AuditEvent.LOGIN, user_id=self.admin.pk)
+        audit.flush()
+
+        response = self.client.get(reverse('api_audit'),
+                                   {'user': self.user.pk})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse('api_audit'),
+                                   {'user': self.user.pk, 'limit': 1})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['event'],
+                         AuditEvent.UPDATE_PROFILE)
+        self.assertEqual(response.data[0]['data'],
+                         {'fields': ['first_name']})
+
+        response = self.client.get(reverse('api_audit'), {'since': 'never'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_purge_audit_events(self):
+        audit.record(AuditEvent.LOGIN, user_id=self.user.pk)
+        audit.record(AuditEvent.LOGIN, user_id=self.user.pk)
+        audit.flush()
+
+        AuditEvent.objects.filter(pk=AuditEvent.objects.first().pk) \
+                          .update(created=timezone.now() - timedelta(days=400))
+
+        out = StringIO()
+        call_command('purge_audit_events', stdout=out)
+
+        self.assertIn('Deleted 1 audit event(s)', out.getvalue())
+        self.assertEqual(AuditEvent.objects.count(), 1)
+
+
+class ShardingTest(SimpleTestCase):
+    def test_jump_hash(self):
+        buckets = Counter(sharding.jump_hash(key, 4) for key in range(10000))
+
+        self.assertEqual(sorted(buckets), [0, 1, 2, 3])
+        for count in buckets.values():
+            self.assertGreater(count, 2000)
+            self.assertLess(count, 3000)
+
+    def test_jump_hash_when_adding_a_bucket(self):
+        moved = 0
+
+        for key in range(10000):
+            before = sharding.jump_hash(key, 4)
+            after = sharding.jump_hash(key, 5)
+
+            # keys only move to the new bucket
+            if after != before:
+                self.assertEqual(after, 4)
+                moved += 1
+
+        self.assertGreater(moved, 1500)
+        self.assertLess(moved, 2500)
+
+    def test_get_shard_for(self):
+        shards = ['shard0', 'shard1', 'shard2']
+
+        self.assertEqual([sharding.get_shard_for(user_id, shards)
+                          for user_id in range(1, 6)],
+                         ['shard0', 'shard0', 'shard2', 'shard1', 'shard1'])
+
+        with override_settings(API_USER_SHARDS=shards):
+            self.assertTrue(sharding.is_enabled())
+            self.assertEqual(sharding.get_shard_for(3), 'shard2')
+
+        self.assertFalse(sharding.is_enabled())
+
+    def test_merge_by_pk(self):
+        def users(*ids):
+            return iter([User(pk=pk) for pk in ids])
+
+        merged = sharding.merge_by_pk([users(1, 4, 7), users(2, 4, 9),
+                                       users()])
+
+        # the user found on two shards is only returned once
+        self.assertEqual([user.pk for user in merged], [1, 2, 4, 7, 9])
+
+    def test_allow_migrate(self):
+        router = sharding.UserShardRouter()
+
+        with override_settings(API_USER_SHARDS=['shard0', 'shard1']):
+            self.assertTrue(router.allow_migrate('shard0', 'auth'))
+            self.assertTrue(router.allow_migrate('shard1', 'oauth2_provider'))
+            self.assertFalse(router.allow_migrate('shard0', 'api'))
+            self.assertIsNone(router.allow_migrate(DEFAULT_DB_ALIAS, 'api'))
+
+
+SHARDS = ['test_shard0', 'test_shard1']
+
+
+@override_settings(API_USER_SHARDS=SHARDS,
+                   ACCOUNT_EMAIL_CONFIRMATION_HMAC=False)
+class ShardedUsersTest(APITestCase):
+    """
+    Runs the API with the users sharded across two SQLite files.
+    """
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+
+        with override_settings(API_USER_SHARDS=SHARDS):
+            for alias in SHARDS:
+                connections.databases[alias] = {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': os.path.join(cls.directory, alias + '.sqlite3'),
+                }
+                call_command('migrate', database=alias, verbosity=0)
+
+        super(ShardedUsersTest, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ShardedUsersTest, cls).tearDownClass()
+
+        for alias in SHARDS:
+            connections[alias].close()
+            delattr(connections._connections, alias)
+            del connections.databases[alias]
+
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        # the directory entries cached by the other tests
+        cache.clear()
+
+        self.password = 'donaldtrump'
+        self.app = Application.objects.create(
+            client_type=Application.CLIENT_PUBLIC,
+            authorization_grant_type=Application.GRANT_PASSWORD)
+
+    def register(self, email):
+        response = self.client.post(reverse('api_register'), {
+            'email': email,
+            'password': self.password,
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        user_id = sharding.UserShard.objects.get(email=email).pk
+        shard = sharding.lookup_shard(user_id)
+        User.objects.using(shard).filter(pk=user_id).update(is_active=True)
+        return user_id, shard
+
+    def test_shard_tables(self):
+        tables = connections[SHARDS[0]].introspection.table_names()
+
+        self.assertIn('auth_user', tables)
+        self.assertIn('oauth2_provider_accesstoken', tables)
+        self.assertNotIn('api_job', tables)
+        self.assertNotIn('api_usershard', tables)
+
+    def test_register_user(self):
+        user_id, shard = self.register('potus@whitehouse.gov')
+
+        self.assertIn(shard, SHARDS)
+        self.assertTrue(User.objects.using(shard).filter(pk=user_id)
+                                                 .exists())
+        self.assertFalse(User.objects.filter(pk=user_id).exists())
+
+        # the e-mail is unique across the shards
+        response = self.client.post(reverse('api_register'), {
+            'email': 'POTUS@whitehouse.gov',
+            'password': self.password,
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_login(self):
+        user_id, shard = self.register('potus@whitehouse.gov')
+
+        response = self.client.post(reverse('api_login'), {
+            'username': 'potus@whitehouse.gov',
+            'password': self.password,
+            'grant_type': 'password',
+            'client_id': self.app.client_id,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # the token is on the shard of the user
+        token = parse_token(response.data['access_token'])
+        self.assertTrue(AccessToken.objects.using(shard)
+                                           .filter(token=token,
+                                                   user_id=user_id)
+                                           .exists())
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % token)
+        response = self.client.get(reverse('api_profile'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['email'], 'potus@whitehouse.gov')
+
+    def test_list_users(self):
+        emails = ['user%s@whitehouse.gov' % i for i in range(6)]
+        users = [self.register(email) for email in emails]
+
+        # both shards hold some of the users
+        self.assertEqual(set(shard for user_id, shard in users),
+                         set(SHARDS))
+
+        response = self.client.get(reverse('api_users'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), len(emails))
+
+    def test_change_email_to_taken_one(self):
+        first_id, first_shard = self.register('potus@whitehouse.gov')
+        self.register('flotus@whitehouse.gov')
+
+        user = User.objects.using(first_shard).get(pk=first_id)
+        user.email = 'flotus@whitehouse.gov'
+
+        with self.assertRaises(IntegrityError):
+            user.save()
+
+        # the user was not written
+        self.assertEqual(User.objects.using(first_shard).get(pk=first_id)
+                                                        .email,
+                         'potus@whitehouse.gov')
+
+
+class PasswordHasherTest(APITestCase):
+    def setUp(self):
+        self.email = 'potus@whitehouse.gov'
+        self.password = 'donaldtrump'
+
+        self.user = User.objects.create_user(username=self.email,
+                                             email=self.email,
+                                             is_active=1)
+        self.user.password = get_hasher().encode(self.password, 'salt',
+                                                 iterations=1000)
+        self.user.save()
+
+        self.app = Application.objects.create(
+            client_type=Application.CLIENT_PUBLIC,
+            authorization_grant_type=Application.GRANT_PASSWORD)
+
+    @override_settings(API_PBKDF2_ITERATIONS=2000)
+    def test_iterations_from_settings(self):
+        self.assertEqual(get_hasher().iterations, 2000)
+        self.assertTrue(make_password('melaniatrump')
+                        .startswith('pbkdf2_sha256$2000$'))
+
+    @override_settings(API_PBKDF2_ITERATIONS=2000)
+    def test_rehash_on_login(self):
+        with mock.patch('django.contrib.auth.base_user.check_password',
+                        wraps=check_password) as checked:
+            response = self.client.post(reverse('api_login'), {
+                'username': self.email,
+                'password': self.password,
+                'grant_type': 'password',
+                'client_id': self.app.client_id,
+            })
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # the password is checked once, and rehashed with 2000 iterations
+        self.assertEqual(checked.call_count, 1)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$2000$'))
+        self.assertTrue(self.user.check_password(self.password))
+
+    @override_settings(API_PBKDF2_ITERATIONS=1000)
+    def test_calibrate_hashers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        path = os.path.join(directory, '.env')
+        with open(path, 'w') as env_file:
+            env_file.write('SECRET_KEY=ivanka\nPBKDF2_ITERATIONS=1\n')
+
+        out = StringIO()
+        call_command('calibrate_hashers', '--target-ms', '1', '--rounds', '1',
+                     '--write', '--env-file', path, stdout=out,
+                     stderr=StringIO())
+
+        self.assertIn('pbkdf2_sha256:', out.getvalue())
+        self.assertIn('hashes/s per core', out.getvalue())
+
+        with open(path) as env_file:
+            lines = env_file.read().splitlines()
+
+        self.assertEqual(lines[0], 'SECRET_KEY=ivanka')
+        self.assertEqual(len(lines), 2)
+        self.assertRegex(lines[1], r'^PBKDF2_ITERATIONS=\d+000$')
+
+
+class ActivityTest(APITestCase):
+    def setUp(self):
+        # drop the timestamps buffered by the other tests
+        activity.flush()
+        UserActivity.objects.all().delete()
+
+        self.email = 'potus@whitehouse.gov'
+        self.password = 'donaldtrump'
+
+        self.user = User.objects.create_user(username=self.email,
+                                             email=self.email,
+                                             password=self.password,
+                                             is_active=1)
+        self.other = User.objects.create_user(username='flotus',
+                                              email='flotus@whitehouse.gov',
+                                              password=self.password,
+                                              is_active=1)
+
+    def test_record_last_login(self):
+        app = Application.objects.create(
+            client_type=Application.CLIENT_PUBLIC,
+            authorization_grant_type=Application.GRANT_PASSWORD)
+        changes = UserChange.objects.count()
+
+        response = self.client.post(reverse('api_login'), {
+            'username': self.email,
+            'password': self.password,
+            'grant_type': 'password',
+            'client_id': app.client_id,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # written by the next flush, not by the login
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.last_login)
+        self.assertEqual(UserChange.objects.count(), changes)
+
+        activity.flush()
+
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+
+    def test_record_last_seen(self):
+        self.client.force_authenticate(self.user)
+        self.client.get(reverse('api_profile'))
+        self.client.get(reverse('api_users'))
+
+        self.assertFalse(UserActivity.objects.exists())
+        self.assertEqual(activity.flush(), 1)
+
+        self.assertEqual(list(UserActivity.objects.values_list('user_id',
+                                                               flat=True)),
+                         [self.user.pk])
+
+    def test_coalesce_timestamps(self):
+        now = timezone.now()
+        earlier = now - timedelta(minutes=5)
+
+        UserActivity.objects.create(user_id=self.other.pk, last_seen=now)
+
+        activity.record_seen(self.user.pk, earlier)
+        activity.record_seen(self.user.pk, now)
+        activity.record_seen(self.user.pk, earlier)
+        activity.record_seen(self.other.pk, earlier)
+
+        self.assertEqual(activity.flush(), 2)
+
+        # the latest timestamps are kept
+        self.assertEqual(UserActivity.objects.get(user_id=self.user.pk)
+                                             .last_seen, now)
+        self.assertEqual(UserActivity.objects.get(user_id=self.other.pk)
+                                             .last_seen, now)
+
+    def test_last_seen_created_meanwhile(self):
+        now = timezone.now()
+        UserActivity.objects.create(user_id=self.other.pk,
+                                    last_seen=now - timedelta(minutes=5))
+
+        # the lookup misses the row created meanwhile by another process
+        lookups = []
+        queryset_filter = UserActivity.objects.filter
+
+        def stale_filter(*args, **kwargs):
+            lookups.append(kwargs)
+            queryset = queryset_filter(*args, **kwargs)
+            return queryset.none() if len(lookups) == 1 else queryset
+
+        with mock.patch.object(UserActivity.objects, 'filter',
+                               side_effect=stale_filter):
+            activity.last_seen_writer.update({self.user.pk: now,
+                                              self.other.pk: now})
+
+        # the new user is inserted, the other one updated
+        self.assertEqual(UserActivity.objects.get(user_id=self.user.pk)
+                                             .last_seen, now)
+        self.assertEqual(UserActivity.objects.get(user_id=self.other.pk)
+                                             .last_seen, now)
+
+
+class AIMDLimiterTest(SimpleTestCase):
+    def setUp(self):
+        self.limiter = limiter.AIMDLimiter(initial=2, min=1, max=3,
+                                           latency=1.0, backoff=0.5)
+
+    def test_reject_over_limit(self):
+        self.assertTrue(self.limiter.acquire())
+        self.assertTrue(self.limiter.acquire())
+        self.assertFalse(self.limiter.acquire())
+
+        self.limiter.release(0.1)
+        self.assertTrue(self.limiter.acquire())
+
+        metrics = self.limiter.get_metrics()
+        self.assertEqual(metrics['inflight'], 2)
+        self.assertEqual(metrics['accepted'], 3)
+        self.assertEqual(metrics['rejected'], 1)
+
+    def test_increase_when_fast(self):
+        for i in range(3):
+            self.limiter.acquire()
+            self.limiter.acquire()
+            self.limiter.release(0.1)
+            self.limiter.release(0.1)
+
+        # up to the maximum
+        self.assertEqual(self.limiter.get_metrics()['limit'], 3)
+
+    def test_decrease_when_slow_or_failed(self):
+        self.limiter.acquire()
+        self.limiter.release(2.0)
+        self.assertEqual(self.limiter.get_metrics()['limit'], 1)
+
+        self.limiter.acquire()
+        self.limiter.release(0.1, failed=True)
+
+        # down to the minimum
+        self.assertEqual(self.limiter.get_metrics()['limit'], 1)
+        self.assertEqual(self.limiter.get_retry_after(), 2)
+
+
+class ConcurrencyLimitTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.user = User.objects.create_user(username='potus',
+                                             email='potus@whitehouse.gov',
+                                             password='donaldtrump',
+                                             is_active=1)
+
+        # a write limit used up by a slow request
+        write = limiter.AIMDLimiter(initial=1, min=1, max=1, latency=1.0)
+        write.acquire()
+
+        patcher = mock.patch.dict(limiter.limiters, {'write': write},
+                                  clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shed_writes(self):
+        response = self.client.post(reverse('api_register'), {
+            'email': 'flotus@whitehouse.gov',
+            'password': 'donaldtrump',
+        })
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(User.objects.filter(username='flotus@whitehouse.gov')
+                                     .exists())
+
+    def test_reads_keep_flowing(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse('api_profile'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        metrics = limiter.get_metrics()
+        self.assertEqual(metrics['read']['accepted'], 1)
+        self.assertEqual(metrics['read']['inflight'], 0)
+
+    def test_metrics(self):
+        self.client.post(reverse('api_register'), {})
+
+        response = self.client.get(reverse('api_limits'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        admin = User.objects.create_superuser(username='admin',
+                                              email='admin@whitehouse.gov',
+                                              password='donaldtrump')
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse('api_limits'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['current']['write']['rejected'], 1)
+
+    def test_hold_slot_while_streaming(self):
+        write = limiter.limiters['write'] = limiter.AIMDLimiter(
+            initial=2, min=1, max=2, latency=1.0)
+
+        admin = User.objects.create_superuser(username='admin',
+                                              email='admin@whitehouse.gov',
+                                              password='donaldtrump')
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse('api_users_export'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # released once the body is sent
+        self.assertEqual(write.get_metrics()['inflight'], 1)
+        b''.join(response.streaming_content)
+        self.assertEqual(write.get_metrics()['inflight'], 0)
+
+    def test_publish_metrics_per_process(self):
+        for process in ('web1:1', 'web2:2'):
+            with mock.patch('api.limiter._slot', None), \
+                    mock.patch('api.limiter._next_publish', 0), \
+                    mock.patch('api.limiter.get_worker_id',
+                               return_value=process):
+                limiter.publish_metrics()
+
+        metrics = limiter.get_all_metrics()
+
+        self.assertEqual(sorted(metrics), ['web1:1', 'web2:2'])
+        self.assertEqual(metrics['web1:1']['classes']['write']['limit'], 1)
@@ -1,7 +1,9 @@
 from django.conf.urls import url
 
 from .views import (LoginView, RegisterView, VerifyEmailView,
-                    ChangePasswordView, UserListView, ProfileView)
+                    ChangePasswordView, UserListView, UserChangesView,
+                    UserExportView, AuditEventListView, ProfileView,
+                    BatchView, ProfilingView, ConcurrencyView)
 
 
 urlpatterns = [
@@ -10,5 +12,11 @@ urlpatterns = [
     url(r'^verify-email/$', VerifyEmailView.as_view(), name='api_verify_email'),  # noqa
     url(r'^change-password/$', ChangePasswordView.as_view(), name='api_change_password'),  # noqa
     url(r'^users/$', UserListView.as_view(), name='api_users'),
-    url(r'^profile/$', ProfileView.as_view(), name='api_profile')
+    url(r'^users/changes/$', UserChangesView.as_view(), name='api_user_changes'),  # noqa
+    url(r'^users/export/$', UserExportView.as_view(), name='api_users_export'),  # noqa
+    url(r'^audit/$', AuditEventListView.as_view(), name='api_audit'),
+    url(r'^profile/$', ProfileView.as_view(), name='api_profile'),
+    url(r'^batch/$', BatchView.as_view(), name='api_batch'),
+    url(r'^profiling/$', ProfilingView.as_view(), name='api_profiling'),
+    url(r'^limits/$', ConcurrencyView.as_view(), name='api_limits'),
 ]
@@ -0,0 +1,79 @@
+from django.contrib.auth.models import User
+from django.db.models import EmailField, Lookup
+from django.db.models.functions import Lower
+from django.utils.translation import ugettext as _
+
+from rest_framework import serializers
+
+from . import sharding
+from .models import UserShard
+
+
+def normalize_email(email):
+    """
+    Returns the form of the e-mail used for uniqueness checks. Must match
+    the expression of the `api_user_email_lower_uniq` index.
+    """
+    return (email or '').strip().lower()
+
+
+@EmailField.register_lookup
+class NonEmpty(Lookup):
+    """
+    `email__nonempty=True`, as `email <> ''` with a literal: SQLite only
+    matches that against the predicate of a partial index, not
+    `NOT (email = %s)` from `exclude(email='')`.
+    """
+    lookup_name = 'nonempty'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        operator = '<>' if self.rhs else '='
+        return "%s %s ''" % (lhs, operator), lhs_params
+
+
+def annotate_email(queryset):
+    """
+    Annotates the users with their normalized e-mail as `email_lower`,
+    leaving out the users without an e-mail like the
+    `api_user_email_lower_uniq` index does, so that filters on
+    `email_lower` are answered by the index.
+    """
+    return queryset.annotate(email_lower=Lower('email')) \
+                   .filter(email__nonempty=True)
+
+
+class UniqueEmailValidator(object):
+    """
+    Validates that no other user has the given e-mail, ignoring case.
+
+    The lookup is done on LOWER(email) so it is answered by the unique
+    expression index created in `api/migrations/0001_user_email_lower_index`
+    instead of a scan over the user table. The index also rejects the
+    concurrent inserts this check cannot see. When the users are sharded,
+    the unique e-mails of the shard directory are checked instead.
+    """
+    message = _('E-mail address is already taken!')
+
+    def __init__(self, queryset=None, message=None):
+        self.queryset = queryset if queryset is not None else User.objects.all()  # noqa
+        self.message = message or self.message
+        self.instance = None
+
+    def set_context(self, serializer_field):
+        # the instance being updated, if any, is excluded from the check
+        self.instance = getattr(serializer_field.parent, 'instance', None)
+
+    def __call__(self, value):
+        if sharding.is_enabled():
+            # users are spread across databases, but not the directory
+            queryset = UserShard.objects.filter(email=normalize_email(value))
+        else:
+            queryset = annotate_email(self.queryset) \
+                .filter(email_lower=normalize_email(value))
+
+        if self.instance is not None:
+            queryset = queryset.exclude(pk=self.instance.pk)
+
+        if queryset.exists():
+            raise serializers.ValidationError(self.message)
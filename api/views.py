@@ -1,12 +1,12 @@
-from allauth.account.utils import send_email_confirmation
 from allauth.account.views import ConfirmEmailView
 
 from django.contrib.auth import authenticate
+from django.contrib.auth.signals import user_logged_in
 from django.contrib.auth.models import User
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.debug import sensitive_post_parameters
 
-from oauth2_provider.models import AccessToken
 from oauth2_provider.views import TokenView
 
 from rest_framework import status
@@ -17,9 +17,17 @@ from rest_framework.views import APIView
 
 from .serializers import (LoginSerializer, AccountSerializer,
                           GuestAccountSerializer, UpdateAccountSerializer,
-                          VerifyEmailSerializer, ChangePasswordSerializer)
-
-from . import permissions
+                          VerifyEmailSerializer, ChangePasswordSerializer,
+                          BatchSerializer, ProfilingSerializer,
+                          AuditEventSerializer, AuditQuerySerializer)
+
+from . import (audit, batch, limiter, permissions, profiling, sharding,
+               sync, tasks)
+from .cache import get_profile_data, get_user_list_data
+from .export import FORMATS, export_users
+from .jobs import enqueue
+from .models import AuditEvent
+from .oauth2_validators import authenticated_user
 
 import json
 import re
@@ -49,6 +57,9 @@ class LoginView(APIView, TokenView):
     save this token somewhere and use it to authenticate other views throughout
     the whole session. Only if the token has expired will the client access
     this view again to generate another access token.
+
+    Passwords hashed with other parameters than the configured ones (see
+    `api.hashers`) are rehashed by `authenticate` on a successful login.
     """
 
     @sensitive_post_parameters_m
@@ -64,16 +75,32 @@ class LoginView(APIView, TokenView):
 
         data = serializer.validated_data
 
-        user = authenticate(username=data.get('username'),
-                            password=data.get('password'))
-
-        if not user:
-            return Response(
-                {'detail': 'Login failed! Make sure username and password '
-                           'is correct, or that the account is activated.'},
-                status=status.HTTP_401_UNAUTHORIZED)
-
-        url, headers, body, _status = self.create_token_response(request)
+        # the user and its new token are on the shard of the user, if any
+        with sharding.use_user_shard(email=data.get('username')):
+            user = authenticate(username=data.get('username'),
+                                password=data.get('password'))
+
+            if not user:
+                audit.record(AuditEvent.LOGIN_FAILED, request=request,
+                             username=data.get('username'))
+                return Response(
+                    {'detail': 'Login failed! Make sure username and '
+                               'password is correct, or that the account '
+                               'is activated.'},
+                    status=status.HTTP_401_UNAUTHORIZED)
+
+            # the password was just checked, it is not hashed again
+            with authenticated_user(data.get('username'),
+                                    data.get('password'), user):
+                url, headers, body, _status = \
+                    self.create_token_response(request)
+
+        if _status == status.HTTP_200_OK:
+            # records the last login, in a batch with other logins
+            user_logged_in.send(sender=user.__class__, request=request,
+                                user=user)
+
+            audit.record(AuditEvent.LOGIN, user_id=user.pk, request=request)
 
         body = json.loads(body)
         access_token = '%s %s' % (body.get('token_type'), body.get('access_token'))  # noqa
@@ -84,7 +111,8 @@ class LoginView(APIView, TokenView):
 class RegisterView(CreateAPIView):
     """
     This view allows the user to register for an account in the site.
-    Uses django-allauth to send a verification e-mail to the user.
+    Uses django-allauth to send a verification e-mail to the user. The
+    e-mail is sent by a background job, see `api.tasks`.
     """
     serializer_class = AccountSerializer
 
@@ -96,7 +124,9 @@ class RegisterView(CreateAPIView):
         user = serializer.save()
 
         # use django-allauth to send verification e-mail
-        send_email_confirmation(self.request._request, user)
+        enqueue(tasks.send_email_confirmation, user_id=user.pk)
+        audit.record(AuditEvent.REGISTER, user_id=user.pk,
+                     request=self.request)
 
         return user
 
@@ -104,7 +134,8 @@ class RegisterView(CreateAPIView):
 class VerifyEmailView(APIView, ConfirmEmailView):
     """
     This view allows the user to verify his e-mail. Uses django-allauth
-    to confirm the e-mail.
+    to confirm the e-mail. The user is activated right away, while marking
+    the e-mail address as verified is left to a background job.
     """
 
     def get_serializer(self, *args, **kwargs):
@@ -114,6 +145,20 @@ class VerifyEmailView(APIView, ConfirmEmailView):
         return Response({"detail": 'Method "GET" not allowed.'},
                         status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def get_object(self, queryset=None):
+        if not sharding.is_enabled():
+            return super(VerifyEmailView, self).get_object(queryset)
+
+        # confirmations are found by key on each database, see
+        # ACCOUNT_EMAIL_CONFIRMATION_HMAC in the settings
+        for alias in sharding.get_databases():
+            confirmation = self.get_queryset().using(alias) \
+                               .filter(key=self.kwargs['key'].lower()).first()
+            if confirmation is not None:
+                return confirmation
+
+        raise Http404()
+
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -124,12 +169,16 @@ class VerifyEmailView(APIView, ConfirmEmailView):
         # use django-allauth to confirm the e-mail
         # automatically issues an HTTP 404 if invalid key is given
         confirmation = self.get_object()
-        confirmation.confirm(self.request)
+        enqueue(tasks.confirm_email_address,
+                email_address_id=confirmation.email_address.pk,
+                user_id=confirmation.email_address.user_id)
 
         # get the associated user and activate it
         user = confirmation.email_address.user
         user.is_active = 1
-        user.save()
+        user.save(update_fields=['is_active'])
+
+        audit.record(AuditEvent.VERIFY_EMAIL, user_id=user.pk, request=request)
 
         account_serializer = AccountSerializer(user)
 
@@ -175,12 +224,12 @@ class ChangePasswordView(APIView):
             return Response({'detail': 'Unauthorized access'},
                             status=status.HTTP_401_UNAUTHORIZED)
 
-        try:
-            token = AccessToken.objects.get(token=token)
-            user = token.user
-        except AccessToken.DoesNotExist:
+        # looked up on each shard when the users are sharded
+        token = sharding.get_access_token(token)
+        if token is None:
             return Response({'detail': 'Invalid access token'},
                             status=status.HTTP_401_UNAUTHORIZED)
+        user = token.user
 
         if not user:
             return Response({'detail': 'User does not exist'},
@@ -195,7 +244,10 @@ class ChangePasswordView(APIView):
                             status=status.HTTP_401_UNAUTHORIZED)
 
         user.set_password(data.get('new_password'))
-        user.save()
+        user.save(update_fields=['password'])
+
+        audit.record(AuditEvent.CHANGE_PASSWORD, user_id=user.pk,
+                     request=request)
 
         return Response({'status': 'OK'}, status=status.HTTP_200_OK)
 
@@ -204,9 +256,17 @@ class UserListView(ListAPIView):
     """
     This view displays the lists of users. If authenticated, full user details
     are shown. If not, only the first names are shown.
+
+    The serialized lists are cached until a user is saved or deleted. When
+    the users are sharded, the shards are merged by user id.
     """
     queryset = User.objects.all()
 
+    def get_users(self, queryset):
+        if sharding.is_enabled():
+            return sharding.iter_users(queryset)
+        return queryset
+
     def get_serializer_class(self):
         user = self.request.user
         if user.is_authenticated() and user.is_active:
@@ -214,12 +274,139 @@ class UserListView(ListAPIView):
         else:
             return GuestAccountSerializer
 
+    def list(self, request, *args, **kwargs):
+        # serialized lists are cached, and rebuilt by a single worker
+        data = get_user_list_data(
+            self.get_serializer_class().__name__,
+            lambda: self.get_serializer(self.get_users(self.get_queryset()),
+                                        many=True).data)
+        return Response(data)
+
+
+class UserChangesView(UserListView):
+    """
+    This view returns the changes to the list of users since the given
+    change sequence number, so that clients can keep a copy of the list
+    up to date without downloading it again.
+
+    Returns the users created or updated (with their id) and the ids of the
+    users deleted since `since`, and the sequence number to pass as `since`
+    next time. If `more` is true, there are more changes to fetch right
+    away. Start with `since=0` to get the whole list.
+
+    Changes are only served `API_SYNC_SETTLE_SECONDS` after they are made,
+    and a transaction open for longer than that may still be missed, see
+    `api.sync`.
+    """
+    max_limit = 1000
+
+    def list(self, request, *args, **kwargs):
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = min(int(request.query_params.get('limit',
+                                                     self.max_limit)),
+                        self.max_limit)
+        except ValueError:
+            return Response({'detail': 'Invalid since or limit'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        upserted, deleted, last_seq, has_more = sync.get_changes(since,
+                                                                 limit)
+
+        users = list(self.get_users(self.get_queryset()
+                                        .filter(pk__in=upserted)
+                                        .order_by('pk')))
+        serializer = self.get_serializer(users, many=True)
+
+        upserts = []
+        for user, data in zip(users, serializer.data):
+            data['id'] = user.pk
+            upserts.append(data)
+
+        # users upserted then deleted by a change not served yet
+        found = set(user.pk for user in users)
+        deleted.extend(pk for pk in upserted if pk not in found)
+
+        return Response({
+            'since': since,
+            'next': last_seq,
+            'more': has_more,
+            'upserts': upserts,
+            'deletes': sorted(deleted),
+        }, status=status.HTTP_200_OK)
+
+
+class UserExportView(APIView):
+    """
+    This view streams all the users as CSV or NDJSON. Only for admins.
+    Use `output` to choose the format and `since` to resume after the
+    last exported user id.
+    """
+    permission_classes = [permissions.IsActiveAdmin, ]
+
+    def get(self, request, *args, **kwargs):
+        output_format = request.query_params.get('output', 'csv')
+        since = request.query_params.get('since')
+
+        if output_format not in FORMATS:
+            return Response({'detail': 'Invalid output format'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return Response({'detail': 'Invalid since'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(
+            export_users(output_format, since=since),
+            content_type=FORMATS[output_format][1])
+        response['Content-Disposition'] = \
+            'attachment; filename="users.%s"' % output_format
+
+        return response
+
+
+class AuditEventListView(APIView):
+    """
+    This view returns the audit events, most recent first. Only for admins.
+    Filter them with `user`, `event`, and `since` and `until` as ISO 8601
+    date-times, and pass the `created` of the last event as `until` to get
+    the next page. Returns at most `limit` events.
+
+    Events are buffered before being written, so the last few seconds of
+    events may be missing.
+    """
+    permission_classes = [permissions.IsActiveAdmin, ]
+
+    def get(self, request, *args, **kwargs):
+        query = AuditQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+
+        params = query.validated_data
+        queryset = AuditEvent.objects.between(params.get('since'),
+                                              params.get('until'))
+
+        if 'user' in params:
+            queryset = queryset.for_user(params['user'])
+        if 'event' in params:
+            queryset = queryset.filter(event=params['event'])
+
+        serializer = AuditEventSerializer(queryset[:params['limit']],
+                                          many=True)
+
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
 
 class ProfileView(RetrieveUpdateAPIView):
     """
     This view displays the user's profile and provides update functionality.
     Upon update, it checks if the e-mail was changed. If changed, the
     username is set to the new e-mail.
+
+    Serialized profiles are cached per user and version stamp. The stamp is
+    bumped whenever the user is saved or deleted, see `api.signals`.
     """
     permission_classes = [permissions.IsAuthenticatedAndActive, ]
     serializer_class = UpdateAccountSerializer
@@ -229,8 +416,9 @@ class ProfileView(RetrieveUpdateAPIView):
 
     def retrieve(self, *args, **kwargs):
         user = self.get_object()
-        serializer = self.get_serializer(user)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        data = get_profile_data(user.pk,
+                                lambda: self.get_serializer(user).data)
+        return Response(data, status=status.HTTP_200_OK)
 
     def perform_update(self, serializer):
         user = self.get_object()
@@ -244,3 +432,95 @@ class ProfileView(RetrieveUpdateAPIView):
                 serializer.save()
         else:
             serializer.save()
+
+        audit.record(AuditEvent.UPDATE_PROFILE, user_id=user.pk,
+                     request=self.request,
+                     fields=sorted(serializer.validated_data))
+
+
+class BatchView(APIView):
+    """
+    This view runs several API calls in a single round trip. The batch is
+    authenticated once, and each sub-request runs as the same user.
+    Consecutive GET requests run concurrently, the others run in order.
+    Returns the status and body of each sub-request, in order.
+    """
+
+    def get_serializer(self, *args, **kwargs):
+        return BatchSerializer(*args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        results = batch.execute(request,
+                                serializer.validated_data['requests'])
+
+        return Response(results, status=status.HTTP_200_OK)
+
+
+class ProfilingView(APIView):
+    """
+    This view controls the sampling profiler of the API views. Only for
+    admins.
+
+    GET returns the profiler configuration and the profiled views, or with
+    `view` the stacks of that view as `collapsed` stacks or a `speedscope`
+    file (see `output`). POST enables profiling of a fraction (`rate`) of
+    the requests to `views` for `duration` seconds. DELETE disables it.
+    """
+    permission_classes = [permissions.IsActiveAdmin, ]
+
+    def get_serializer(self, *args, **kwargs):
+        return ProfilingSerializer(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        view_name = request.query_params.get('view')
+
+        if view_name is None:
+            return Response({'config': profiling.get_config(),
+                             'views': profiling.get_profiled_views()},
+                            status=status.HTTP_200_OK)
+
+        output_format = request.query_params.get('output', 'collapsed')
+
+        if output_format not in profiling.EXPORTERS:
+            return Response({'detail': 'Invalid output format'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        content_type = profiling.EXPORTERS[output_format][1]
+        return HttpResponse(profiling.export(view_name, output_format),
+                            content_type=content_type)
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        data = serializer.validated_data
+        profiling.enable(dict((view_name, data['rate'])
+                              for view_name in data['views']),
+                         data['duration'])
+
+        return Response({'config': profiling.get_config()},
+                        status=status.HTTP_200_OK)
+
+    def delete(self, request, *args, **kwargs):
+        profiling.disable()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ConcurrencyView(APIView):
+    """
+    This view returns the concurrency limits of the API views per class:
+    the current limit, the requests running, accepted and rejected, and
+    the average latency in seconds. Only for admins.
+
+    `processes` has the latest metrics published by each process, and
+    `current` the ones of the process serving the request.
+    """
+    permission_classes = [permissions.IsActiveAdmin, ]
+
+    def get(self, request, *args, **kwargs):
+        return Response({'current': limiter.get_metrics(),
+                         'processes': limiter.get_all_metrics()},
+                        status=status.HTTP_200_OK)
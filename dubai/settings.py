@@ -61,6 +61,9 @@ MIDDLEWARE_CLASSES = [
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.limiter.ConcurrencyLimitMiddleware',
+    'api.activity.ActivityMiddleware',
+    'api.profiling.SamplingProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'dubai.urls'
@@ -91,10 +94,133 @@ DATABASES = {
     'default': env.db()
 }
 
+# User sharding, see api/sharding.py
+# Each URL of USER_SHARD_URLS adds a database holding a share of the users
+# and their tokens, e.g. sqlite:///shard0.sqlite3,sqlite:///shard1.sqlite3
+# Move the users with `python manage.py rebalance_users`.
+
+API_USER_SHARDS = []
+
+for index, url in enumerate(env.list('USER_SHARD_URLS', default=[])):
+    API_USER_SHARDS.append('shard%s' % index)
+    DATABASES['shard%s' % index] = env.db_url_config(url)
+
+DATABASE_ROUTERS = ['api.sharding.UserShardRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+# Use a shared backend (e.g. memcache://) when running multiple workers,
+# otherwise cache invalidations are only seen by the worker that made them.
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://')
+}
+
+API_PROFILE_CACHE_TIMEOUT = 300
+API_USER_LIST_CACHE_TIMEOUT = 60
+
+# tokens are only cached in a shared cache, the other workers would accept
+# a revoked token until it expires from their own memory
+API_TOKEN_CACHE_TIMEOUT = 60
+if CACHES['default']['BACKEND'].endswith('LocMemCache'):
+    API_TOKEN_CACHE_TIMEOUT = 0
+
+# expired entries are served for this long while one worker recomputes them
+API_CACHE_STALE_TIMEOUT = 30
+API_CACHE_LOCK_TIMEOUT = 10
+
+
+# Background jobs, see api/jobs.py
+# Run the worker with `python manage.py runjobs`.
+
+API_JOBS_EAGER = env.bool('JOBS_EAGER', default=False)
+API_JOBS_RETRY_DELAY = 30  # seconds before the first retry, then doubled
+API_JOBS_STALE_TIMEOUT = 600  # seconds before a running job is requeued
+API_JOBS_RETENTION_DAYS = 7  # finished jobs are then deleted by the worker
+
+
+# Batch requests, see api/batch.py
+
+API_BATCH_MAX_SIZE = 20  # sub-requests per batch
+API_BATCH_MAX_WORKERS = 4  # threads running consecutive GET requests
+
+
+# User list sync, see api/sync.py
+# Compact the change log with `python manage.py compact_user_changes`.
+
+# must be longer than the transactions writing users, see api/sync.py
+API_SYNC_SETTLE_SECONDS = 1
+
+
+# Sampling profiler, see api/profiling.py
+# Control it with `python manage.py profile_views` or /api/profiling/.
+
+API_PROFILING_INTERVAL = 0.005  # seconds between samples
+API_PROFILING_MAX_STACKS = 5000  # distinct stacks kept per view
+
+
+# Last login and last seen times, see api/activity.py
+
+API_ACTIVITY_MAX_STALENESS = 60  # seconds before a timestamp is written
+API_ACTIVITY_BATCH_SIZE = 1000
+API_ACTIVITY_MAX_BUFFER = 100000  # users buffered before dropping updates
+
+
+# Audit trail, see api/audit.py
+# Purge old events with `python manage.py purge_audit_events`.
+
+API_AUDIT_BATCH_SIZE = 500
+API_AUDIT_FLUSH_INTERVAL = 2  # seconds
+API_AUDIT_MAX_BUFFER = 10000  # events buffered before dropping new ones
+API_AUDIT_RETENTION_DAYS = 365
+
+
+# Concurrency limits per class of views, see api/limiter.py
+# Limits are per process and adapt between `min` and `max` to keep the
+# latency (in seconds) of the class under `latency`. See the metrics at
+# /api/limits/.
+
+API_CONCURRENCY_LIMITS_ENABLED = True
+API_CONCURRENCY_BACKOFF = 0.9  # limit kept after a slow or failed request
+
+# API_CONCURRENCY_CLASSES = {
+#     'api_register': 'write',
+#     'api_login': 'write',
+#     'api_verify_email': 'write',
+#     'api_change_password': 'write',
+#     'api_batch': 'write',
+#     'api_users_export': 'write',
+#     'api_users': 'read',
+#     'api_user_changes': 'read',
+#     'api_profile': 'read',
+# }
+
+# API_CONCURRENCY_LIMITS = {
+#     'write': {'initial': 10, 'min': 1, 'max': 50, 'latency': 1.0},
+#     'read': {'initial': 50, 'min': 5, 'max': 200, 'latency': 0.25},
+# }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
+# Password hashing
+# Calibrate the cost of a hash with `python manage.py calibrate_hashers`.
+# PBKDF2_ITERATIONS defaults to the Django default when unset.
+
+PASSWORD_HASHERS = [
+    'api.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.BCryptPasswordHasher',
+]
+
+API_PBKDF2_ITERATIONS = env.int('PBKDF2_ITERATIONS', default=0)
+API_PASSWORD_HASH_TARGET_MS = 250
+
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -135,6 +261,10 @@ STATIC_URL = '/static/'
 
 SITE_ID = 1
 
+# HMAC confirmation keys hold the id of the e-mail address, which is not
+# unique across the user shards
+ACCOUNT_EMAIL_CONFIRMATION_HMAC = not API_USER_SHARDS
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_USE_TLS = True
 EMAIL_HOST = env('EMAIL_HOST')
@@ -143,6 +273,10 @@ EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
 EMAIL_PORT = env('EMAIL_PORT')
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+OAUTH2_PROVIDER = {
+    'OAUTH2_VALIDATOR_CLASS': 'api.oauth2_validators.CachedOAuth2Validator',
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'oauth2_provider.ext.rest_framework.OAuth2Authentication',
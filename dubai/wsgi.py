@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dubai.settings")
 
 application = get_wsgi_application()
+
+# write buffered data (e.g. the audit trail) from background threads
+from api.buffers import enable_background_flush  # noqa
+enable_background_flush()